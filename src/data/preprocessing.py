@@ -1,29 +1,46 @@
 from matplotlib.backends.backend_pdf import PdfPages
 from matplotlib import pyplot as plt
+from multiprocessing import Pool
 import pandas as pd
 import numpy as np
 import argparse
+import hashlib
+import io
+import shutil
+import json
 import time
 import os
 
 # Return argparse arguments. 
 def setup():
     parser = argparse.ArgumentParser(
-        description = 'Create a HDF file with a set of peaks.')
+        description = 'Create a columnar store or HDF file with a set of peaks.')
 
     parser.version = 0.4
 
     parser.add_argument(
         '-i', 
         '--ipd', 
-        required = True,
+        default = False,
         help = 'IPD ratios table.')
 
     parser.add_argument(
         '-f', 
         '--fold-change',
         default = False, 
-        help = 'Fold change file.')
+        help = 'Fold change file, either per base or as bedGraph intervals.')
+
+    parser.add_argument(
+        '--fold-change-format',
+        default = 'auto',
+        choices = ['auto', 'bases', 'intervals'],
+        help = 'Format of the fold change file. Auto uses intervals for .bedgraph and .bdg files.')
+
+    parser.add_argument(
+        '--fold-change-offset',
+        default = 1,
+        type = int,
+        help = 'Added to interval coordinates to match the 1-based ipdSummary index. The default maps a standard 0-based bedGraph, use 0 for intervals that are already 1-based.')
 
     parser.add_argument(
         '-p', 
@@ -31,7 +48,60 @@ def setup():
         default = False,
         help = 'Output prefix.')
 
-    return parser.parse_args()
+    parser.add_argument(
+        '-c',
+        '--chunk-size',
+        default = 0,
+        type = int,
+        help = 'Number of IPD rows to read at a time. Streams the input when set.')
+
+    parser.add_argument(
+        '--format',
+        default = 'columns',
+        choices = ['columns', 'hdf'],
+        help = 'Output format. A folder of memory-mappable columns or a HDF table.')
+
+    parser.add_argument(
+        '-s',
+        '--statistics',
+        default = False,
+        help = 'Normalize with the statistics file of an earlier run instead of this sample.')
+
+    parser.add_argument(
+        '--compact',
+        action = 'store_true',
+        default = False,
+        help = 'Store single precision features, int8 base encodings and the raw coverage.')
+
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        default = 1,
+        type = int,
+        help = 'Number of processes. Chromosomes are processed in parallel when above one.')
+
+    parser.add_argument(
+        '--cache',
+        action = 'store_true',
+        default = False,
+        help = 'Reuse chromosomes whose input did not change since an earlier run.')
+
+    parser.add_argument(
+        '--skip-plot',
+        action = 'store_true',
+        default = False,
+        help = 'Only save the histogram counts and do not draw the report.')
+
+    parser.add_argument(
+        '--plot-counts',
+        default = False,
+        help = 'Draw the histogram report from a saved counts file and exit.')
+
+    arguments = parser.parse_args()
+    if not (arguments.ipd or arguments.plot_counts):
+        parser.error('the following arguments are required: -i/--ipd')
+
+    return arguments
 
 # Start the timer. 
 def start_time(string = None):
@@ -58,188 +128,913 @@ def project_path():
     
     return project_folder
 
-# Plot histograms of the data. 
-def plot(data, filename, fold_change):
-   
-    columns = [
-        ('fold_change', 'Fold Change', np.linspace(0, 20, 101)),
-        ('top_ipd', 'Top IPD', np.linspace(0, 5, 101)),
-        ('bottom_ipd', 'Bottom IPD', np.linspace(0, 5, 101)),
-        ('top_coverage', 'Top Coverage', np.linspace(0, 1000, 101)),
-        ('bottom_coverage', 'Bottom Coverage', np.linspace(0, 1000, 101)),
-        ('top_score', 'Top Score', np.linspace(0, 100, 101)),
-        ('bottom_score', 'Bottom Score', np.linspace(0, 100, 101)),
-        ('top_mean', 'Top Mean', np.linspace(0, 10, 101)),
-        ('bottom_mean', 'Bottom Mean', np.linspace(0, 10, 101)),
-        ('top_error', 'Top Error', np.linspace(0, 2, 101)),
-        ('bottom_error', 'Bottom Error', np.linspace(0, 2, 101))
-    ]
+# Columns shown in the histogram report and their fixed bins. 
+histogram_columns = [
+    ('fold_change', 'Fold Change', np.linspace(0, 20, 101)),
+    ('top_ipd', 'Top IPD', np.linspace(0, 5, 101)),
+    ('bottom_ipd', 'Bottom IPD', np.linspace(0, 5, 101)),
+    ('top_coverage', 'Top Coverage', np.linspace(0, 1000, 101)),
+    ('bottom_coverage', 'Bottom Coverage', np.linspace(0, 1000, 101)),
+    ('top_score', 'Top Score', np.linspace(0, 100, 101)),
+    ('bottom_score', 'Bottom Score', np.linspace(0, 100, 101)),
+    ('top_mean', 'Top Mean', np.linspace(0, 10, 101)),
+    ('bottom_mean', 'Bottom Mean', np.linspace(0, 10, 101)),
+    ('top_error', 'Top Error', np.linspace(0, 2, 101)),
+    ('bottom_error', 'Bottom Error', np.linspace(0, 2, 101))
+]
+
+# Columns that are mean and standard deviation normalized. 
+normalized_columns = [
+    'top_ipd',
+    'bottom_ipd',
+    'top_coverage',
+    'bottom_coverage',
+    'top_score',
+    'bottom_score',
+    'top_mean',
+    'bottom_mean',
+    'top_error',
+    'bottom_error'
+]
+
+# Add the histogram bin counts of the data to the running counts. 
+def histogram(data, counts = None):
+    if counts is None:
+        counts = {}
+
+    for index, name, bins in histogram_columns:
+        if index not in data:
+            continue
+        current = data[index][~pd.isnull(data[index])]
+        values, edges = np.histogram(current, bins = bins)
+        counts[index] = counts.get(index, 0) + values
+
+    return counts
+
+# Write the histogram bin counts to a JSON file so the report can be drawn 
+# later without the data. 
+def save_counts(counts, filename):
+    output = {}
+    for index, name, bins in histogram_columns:
+        if index not in counts:
+            continue
+        output[index] = {
+            'bins': bins.tolist(), 
+            'counts': counts[index].tolist()
+        }
+
+    with open(filename, 'w') as outfile:
+        json.dump(output, outfile, indent = 4)
+
+# Read histogram bin counts written by save_counts. 
+def load_counts(filename):
+    with open(filename) as infile:
+        contents = json.load(infile)
+
+    return {index: np.array(current['counts']) for index, current in contents.items()}
 
+# Plot histograms from the bin counts. Only the bins are drawn, so this does 
+# not depend on the size of the data. 
+def plot(counts, filename):
     with PdfPages(filename) as pdf: 
-        for column in columns:
-            if (not fold_change) and (column[0] == 'fold_change'):
+        for index, name, bins in histogram_columns:
+            if index not in counts:
                 continue
-            index = column[0]
-            name = column[1]
-            bins = column[2]
-            current = data[index][~pd.isnull(data[index])]
 
             plt.figure(figsize = (6,6), dpi = 100)
-            plt.hist(current, bins = bins)
+            plt.hist(bins[:-1], bins = bins, weights = counts[index])
             plt.title(name)
             pdf.savefig()
             plt.close()
 
+# Merge two sets of running statistics (count, mean and sum of squared 
+# deviations) with the parallel form of Welford's algorithm. 
+def combine(first, second):
+    count = first['count'] + second['count']
+    if count == 0:
+        return dict(first)
+    delta = second['mean'] - first['mean']
+    mean = first['mean'] + delta * second['count'] / count
+    m2 = first['m2'] + second['m2'] + delta * delta * first['count'] * second['count'] / count
+
+    return {'count': count, 'mean': mean, 'm2': m2}
+
+# Add the values of each normalized column to the running statistics. 
+def accumulate(data, statistics = None):
+    if statistics is None:
+        statistics = {}
+
+    for column in normalized_columns:
+        values = data[column].values.astype(np.float64)
+        values = values[~np.isnan(values)]
+        current = {'count': 0, 'mean': 0.0, 'm2': 0.0}
+        if len(values):
+            mean = values.mean()
+            current = {
+                'count': len(values), 
+                'mean': float(mean), 
+                'm2': float(np.square(values - mean).sum())
+            }
+        statistics[column] = combine(statistics.get(column, {'count': 0, 'mean': 0.0, 'm2': 0.0}), current)
+
+    return statistics
+
+# Mean and sample standard deviation of each column from the running 
+# statistics. 
+def moments(statistics):
+    output = {}
+    for column, current in statistics.items():
+        output[column] = (current['mean'], np.sqrt(current['m2'] / (current['count'] - 1)))
+
+    return output
+
+# Write the running statistics to a JSON file. 
+def save_statistics(statistics, filename):
+    output = {}
+    for column, (mean, std) in moments(statistics).items():
+        output[column] = dict(statistics[column], std = std)
+
+    with open(filename, 'w') as outfile:
+        json.dump(output, outfile, indent = 4)
+
+# Read running statistics written by save_statistics. 
+def load_statistics(filename):
+    with open(filename) as infile:
+        contents = json.load(infile)
+
+    statistics = {}
+    for column, current in contents.items():
+        statistics[column] = {
+            'count': current['count'], 
+            'mean': current['mean'], 
+            'm2': current['m2']
+        }
+
+    return statistics
+
 # Mean and standard deviation normalization of the data. 
-def normalize(data):
-
-    columns = [
-        'top_ipd',
-        'bottom_ipd',
-        'top_coverage',
-        'bottom_coverage',
-        'top_score',
-        'bottom_score',
-        'top_mean',
-        'bottom_mean',
-        'top_error',
-        'bottom_error'
-    ]
-
-    for column in columns:
-        data[column] = (data[column] - data[column].mean())/data[column].std()
+def normalize(data, averages):
+    for column in normalized_columns:
+        mean, std = averages[column]
+        data[column] = (data[column] - mean)/std
 
     return data
 
-def main():
-    total_start = start_time()
-    # Get argparse arguments. 
-    arguments = setup()
-    
-    # If there is ChIP data: 
-    if arguments.fold_change:
-        start = start_time('Reading fold change file.')
-        fold_change = pd.read_csv(
-            arguments.fold_change,
-            dtype = {
-                'chromosome': 'category'
-                })
-
-        # Set Multindex. 
-        fold_change.set_index([
-            'chromosome', 
-            'position'
+# Path of the raw file holding one column of one chromosome in a store. 
+def column_path(folder, entry, column):
+    return os.path.join(folder, entry['folder'], f'{column}.bin')
+
+# Read the manifest of a store. 
+def read_manifest(folder):
+    with open(os.path.join(folder, 'manifest.json')) as infile:
+        return json.load(infile)
+
+# Open an empty columnar store. Each chromosome gets a folder with one raw 
+# binary file per column and the manifest records the dtypes and lengths, so 
+# readers can memory-map single columns. 
+def open_store(folder):
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.makedirs(folder)
+
+    return {
+        'folder': folder,
+        'columns': None,
+        'chromosomes': []
+    }
+
+# Append a table indexed by chromosome and position to the store. 
+def append_store(store, data):
+    if store['columns'] is None:
+        store['columns'] = {'position': data.index.get_level_values('position').values.dtype.str}
+        for column in data.columns:
+            store['columns'][column] = data[column].values.dtype.str
+
+    entries = {entry['name']: entry for entry in store['chromosomes']}
+    chromosomes = data.index.get_level_values('chromosome')
+    for chromosome in pd.unique(chromosomes):
+        chromosome = str(chromosome)
+        if chromosome not in entries:
+            entry = {
+                'name': chromosome,
+                'folder': str(len(store['chromosomes'])),
+                'length': 0
+            }
+            os.makedirs(os.path.join(store['folder'], entry['folder']))
+            store['chromosomes'].append(entry)
+            entries[chromosome] = entry
+        entry = entries[chromosome]
+
+        selection = np.asarray(chromosomes == chromosome)
+        arrays = {'position': data.index.get_level_values('position').values[selection]}
+        for column in data.columns:
+            arrays[column] = data[column].values[selection]
+
+        for column, dtype in store['columns'].items():
+            with open(column_path(store['folder'], entry, column), 'ab') as outfile:
+                arrays[column].astype(dtype, copy = False).tofile(outfile)
+        entry['length'] += int(selection.sum())
+
+# Write the manifest of the store. 
+def close_store(store):
+    manifest = {
+        'format': 'columns',
+        'version': 1,
+        'columns': store['columns'],
+        'chromosomes': store['chromosomes']
+    }
+
+    with open(os.path.join(store['folder'], 'manifest.json'), 'w') as outfile:
+        json.dump(manifest, outfile, indent = 4)
+
+# Memory-map one column of one chromosome. 
+def map_column(folder, manifest, entry, column, mode = 'r'):
+    dtype = np.dtype(manifest['columns'][column])
+    if entry['length'] == 0:
+        return np.zeros(0, dtype = dtype)
+    return np.memmap(
+        column_path(folder, entry, column), 
+        dtype = dtype, 
+        mode = mode, 
+        shape = (entry['length'],))
+
+# Normalize and round the store in place, one slice of each column at a time. 
+def normalize_store(folder, averages, chunk_size):
+    manifest = read_manifest(folder)
+    for entry in manifest['chromosomes']:
+        for column, dtype in manifest['columns'].items():
+            if (column == 'position') or (np.dtype(dtype).kind != 'f'):
+                continue
+
+            values = map_column(folder, manifest, entry, column, 'r+')
+            for i in range(0, len(values), chunk_size):
+                current = values[i:i + chunk_size]
+                if column in averages:
+                    mean, std = averages[column]
+                    current = (current - mean)/std
+                values[i:i + chunk_size] = np.round(current, 4)
+
+            if isinstance(values, np.memmap):
+                values.flush()
+            del values
+
+# Write a store back out as a HDF table, one chromosome at a time. 
+def store_to_hdf(folder, filename):
+    if os.path.exists(filename):
+        os.remove(filename)
+
+    manifest = read_manifest(folder)
+    for entry in manifest['chromosomes']:
+        arrays = {}
+        for column in manifest['columns']:
+            arrays[column] = np.array(map_column(folder, manifest, entry, column))
+        positions = arrays.pop('position')
+        index = pd.MultiIndex.from_arrays([
+                np.repeat(entry['name'], len(positions)), 
+                positions
             ], 
-            inplace = True)
-        end_time(start)
+            names = ['chromosome', 'position'])
+
+        pd.DataFrame(arrays, index = index).to_hdf(filename, 
+            key = 'data', 
+            format = 'table', 
+            append = True, 
+            min_itemsize = {'chromosome': 64})
+
+# Columns stored in single precision in the compact schema. 
+float_columns = normalized_columns + ['fold_change']
+
+# Keep a copy of the integer coverage before it is normalized. 
+def raw_coverage(data):
+    for strand in ['top', 'bottom']:
+        data[f'{strand}_coverage_raw'] = data[f'{strand}_coverage'].values.astype(np.int32)
 
-    # Load the IPD data. 
-    start = start_time('Reading IPD file.')
-    ipd = pd.read_csv(
-        arguments.ipd, 
-        usecols = [
-            'ref_name',
-            'index',
-            'base',
-            'strand',
-            'score',
-            'trimmed_mean',
-            'trimmed_error',
-            'ipd_ratio',
-            'case_coverage'
+    return data
+
+# Cast the table to the compact schema: single precision kinetics, int8 base 
+# encodings and 32 bit positions. Chromosomes stay categorical codes. 
+def compact(data):
+    types = {}
+    for column in data.columns:
+        if column in float_columns:
+            types[column] = np.float32
+        elif data[column].dtype == bool:
+            types[column] = np.int8
+    data = data.astype(types)
+
+    data.index = pd.MultiIndex.from_arrays([
+            data.index.get_level_values('chromosome'), 
+            data.index.get_level_values('position').values.astype(np.int32)
         ], 
+        names = ['chromosome', 'position'])
+
+    return data
+
+# Memory used by a table and its index in bytes. 
+def table_bytes(data):
+    return int(data.memory_usage(index = True, deep = True).sum())
+
+# Print the memory saved by the compact schema. 
+def report_savings(sizes):
+    before, after = sizes
+    print (f'Compact schema uses {after / 1e6:.1f} MB instead of {before / 1e6:.1f} MB '
+           f'({100 * (1 - after / before):.0f}% saved).')
+
+# Split a fold change table into sorted interval start, end and value arrays 
+# for each chromosome. 
+def fold_change_intervals(fold_change):
+    output = {}
+    for chromosome, group in fold_change.groupby('chromosome', observed = True):
+        starts = group['start'].values.astype(np.int64)
+        ends = group['end'].values.astype(np.int64)
+        values = group['fold_change'].values.astype(np.float64)
+        order = np.argsort(starts, kind = 'stable')
+        output[str(chromosome)] = (starts[order], ends[order], values[order])
+
+    return output
+
+# Read a per-base fold change file (chromosome, position and fold_change 
+# columns) as intervals of one base. 
+def read_fold_change(filename):
+    fold_change = pd.read_csv(
+        filename,
         dtype = {
-            'ref_name': 'category',
-            'base': 'category'
-        })
-    ipd.rename(
-        columns = {
-            'ref_name': 'chromosome', 
-            'index': 'position',
-        },
-        inplace = True)
-    ipd.set_index([
-            'chromosome', 
-            'position'
+            'chromosome': 'category'
+            })
+    fold_change['start'] = fold_change['position']
+    fold_change['end'] = fold_change['position'] + 1
+
+    return fold_change_intervals(fold_change)
+
+# Read a bedGraph-style fold change track (chromosome, start, end and value 
+# separated by whitespace, end exclusive). Intervals must not overlap. The 
+# offset is added to the coordinates to match the IPD index, 1 by default for 
+# a standard 0-based bedGraph against the 1-based ipdSummary index. 
+def read_fold_change_intervals(filename, offset = 1):
+    skip = 0
+    with open(filename) as infile:
+        for line in infile:
+            if not line.startswith(('track', 'browser', '#')):
+                break
+            skip += 1
+
+    fold_change = pd.read_csv(
+        filename,
+        sep = r'\s+',
+        header = None,
+        skiprows = skip,
+        usecols = [0, 1, 2, 3],
+        names = ['chromosome', 'start', 'end', 'fold_change'],
+        dtype = {
+            'chromosome': 'category'
+            })
+
+    values = pd.to_numeric(fold_change['fold_change'], errors = 'coerce')
+    invalid = (values.isna() & fold_change['fold_change'].notna()).values
+    if invalid.any():
+        row = np.flatnonzero(invalid)[0]
+        raise ValueError(f'The fourth column of {filename} must be a numeric fold change, found {fold_change["fold_change"].iloc[row]!r}. A BED file with a name column is not a value track.')
+    fold_change['fold_change'] = values
+    fold_change['start'] += offset
+    fold_change['end'] += offset
+
+    return fold_change_intervals(fold_change)
+
+# Arguments shared by every read of the IPD file. 
+ipd_options = {
+    'usecols': [
+        'ref_name',
+        'index',
+        'base',
+        'strand',
+        'score',
+        'trimmed_mean',
+        'trimmed_error',
+        'ipd_ratio',
+        'case_coverage'
+    ],
+    'dtype': {
+        'ref_name': 'category',
+        'base': 'category'
+    }
+}
+
+# Names of the IPD value columns in the paired table. 
+column_names = {
+    'score': 'score',
+    'trimmed_mean': 'mean',
+    'trimmed_error': 'error',
+    'ipd_ratio': 'ipd',
+    'case_coverage': 'coverage'
+}
+
+# Hold back the rows of the last position in each chunk of IPD rows for the 
+# next one so both strands of a position (and any duplicates) stay together. 
+# Assumes the rows are sorted by reference and position, as ipdSummary writes 
+# them. 
+def hold_positions(chunks):
+    remainder = None
+    for chunk in chunks:
+        if remainder is not None:
+            chunk = pd.concat([remainder, chunk])
+
+        last = (chunk['ref_name'].values[-1], chunk['index'].values[-1])
+        held = (chunk['ref_name'] == last[0]).values & (chunk['index'] == last[1]).values
+        remainder = chunk[held]
+        yield chunk[~held]
+
+    if (remainder is not None) and len(remainder):
+        yield remainder
+
+# Read the IPD file in chunks of rows that keep positions whole. 
+def read_chunks(filename, chunk_size):
+    return hold_positions(pd.read_csv(filename, chunksize = chunk_size, **ipd_options))
+
+# Columns of the IPD table that identify a row rather than hold a value. 
+key_columns = ['ref_name', 'index', 'base', 'strand']
+
+# Encoded bases, in the order of the one-hot columns. 
+bases = ['A', 'C', 'G', 'T']
+
+# Pair the top and bottom strand rows of each position into one wide row with 
+# one-hot encoded bases, joining the fold change when present. Rows are sorted 
+# by chromosome, position and strand (a no-op for ipdSummary output, which is 
+# already sorted), after which duplicates and pairs are found by comparing 
+# neighbouring rows in a single pass. The first row of a duplicated position 
+# and strand is kept. 
+def pair_strands(ipd, fold_change = None):
+    codes, names = pd.factorize(ipd['ref_name'].values)
+    names = [str(name) for name in names]
+    positions = ipd['index'].values.astype(np.int64)
+    strands = ipd['strand'].values
+
+    keep = (strands == 0) | (strands == 1)
+    rows = np.flatnonzero(keep)
+    codes, positions, strands = codes[keep], positions[keep], strands[keep]
+
+    # Sort only if the rows are out of order. 
+    ordered = (np.diff(codes) > 0) | \
+              ((np.diff(codes) == 0) & (np.diff(positions) > 0)) | \
+              ((np.diff(codes) == 0) & (np.diff(positions) == 0) & (np.diff(strands) >= 0))
+    if not ordered.all():
+        order = np.lexsort((strands, positions, codes))
+        rows, codes, positions, strands = rows[order], codes[order], positions[order], strands[order]
+
+    # Keep the first row of each chromosome, position and strand. 
+    same_position = (codes[1:] == codes[:-1]) & (positions[1:] == positions[:-1])
+    first = np.ones(len(rows), dtype = bool)
+    first[1:] = ~(same_position & (strands[1:] == strands[:-1]))
+    rows, codes, positions, strands = rows[first], codes[first], positions[first], strands[first]
+
+    # A top strand row followed by a bottom strand row of the same position is 
+    # a pair. 
+    same_position = (codes[1:] == codes[:-1]) & (positions[1:] == positions[:-1])
+    top = np.flatnonzero(same_position & (strands[:-1] == 0) & (strands[1:] == 1))
+    bottom = top + 1
+    codes, positions = codes[top], positions[top]
+    top, bottom = rows[top], rows[bottom]
+
+    # Join the fold change interval that covers each paired position, dropping 
+    # positions without one. 
+    if fold_change is not None:
+        values = np.full(len(top), np.nan)
+        found = np.zeros(len(top), dtype = bool)
+        for code, chromosome in enumerate(names):
+            if chromosome not in fold_change:
+                continue
+            selection = np.flatnonzero(codes == code)
+            starts, ends, known_values = fold_change[chromosome]
+            index = np.searchsorted(starts, positions[selection], side = 'right') - 1
+            hits = index >= 0
+            hits[hits] = positions[selection[hits]] < ends[index[hits]]
+            values[selection[hits]] = known_values[index[hits]]
+            found[selection[hits]] = True
+        codes, positions, values = codes[found], positions[found], values[found]
+        top, bottom = top[found], bottom[found]
+
+    # Build the wide table. 
+    encodings = pd.Categorical(ipd['base'], categories = bases).codes
+    output = {}
+    for strand, selection in [('top', top), ('bottom', bottom)]:
+        for column in ipd.columns:
+            if column in key_columns:
+                continue
+            name = column_names[column]
+            output[f'{strand}_{name}'] = ipd[column].values[selection]
+
+        encoding = encodings[selection]
+        for i, base in enumerate(bases):
+            output[f'{strand}_{base}'] = encoding == i
+
+    if fold_change is not None:
+        output['fold_change'] = values
+
+    index = pd.MultiIndex.from_arrays([
+            pd.Categorical.from_codes(codes, names), 
+            positions
         ],
-        inplace = True)
-
-    top_strand = ipd[ipd['strand'] == 0].drop(columns = ['strand'])
-    top_strand = top_strand.loc[~top_strand.index.duplicated()]
-    bottom_strand = ipd[ipd['strand'] == 1].drop(columns = ['strand'])
-    bottom_strand = bottom_strand.loc[~bottom_strand.index.duplicated()]
-
-    # Rename columns so they are unique for top and bottom strand. 
-    top_strand.rename(
-        columns = {
-            'base': 'top_base',
-            'score': 'top_score',
-            'trimmed_mean': 'top_mean',
-            'trimmed_error': 'top_error',
-            'ipd_ratio': 'top_ipd',
-            'case_coverage': 'top_coverage'
-        },
-        inplace = True)
-
-    bottom_strand.rename(
-        columns = {
-            'base': 'bottom_base',
-            'score': 'bottom_score',
-            'trimmed_mean': 'bottom_mean',
-            'trimmed_error': 'bottom_error',
-            'ipd_ratio': 'bottom_ipd',
-            'case_coverage': 'bottom_coverage'
-        },
-        inplace = True)
+        names = ['chromosome', 'position'])
+
+    return pd.DataFrame(output, index = index)
+
+# Default number of rows read at a time when the input has to be split. 
+default_chunk_size = 1000000
+
+# Pair the strands of each chunk of IPD rows and append them to a columnar 
+# store while collecting histogram counts and column statistics. With stored 
+# statistics each chunk is normalized before it is written. Also returns the 
+# size of the written tables with and without the compact schema. 
+def ingest(chunks, fold_change, folder, statistics = None, compact_schema = False):
+    counts = {}
+    sample = {}
+    sizes = [0, 0]
+    store = open_store(folder)
+
+    rows = 0
+    for chunk in chunks:
+        chunk = pair_strands(chunk, fold_change)
+        if not len(chunk):
+            continue
+        if compact_schema:
+            chunk = raw_coverage(chunk)
+
+        # Normalized columns are stored as floats so they can be normalized in place. 
+        chunk = chunk.astype({column: np.float64 for column in normalized_columns})
+        counts = histogram(chunk, counts)
+        sample = accumulate(chunk, sample)
+        if statistics is not None:
+            chunk = normalize(chunk, moments(statistics)).round(4)
+
+        if compact_schema:
+            sizes[0] += table_bytes(chunk.drop(columns = ['top_coverage_raw', 'bottom_coverage_raw']))
+            chunk = compact(chunk)
+        sizes[1] += table_bytes(chunk)
+        append_store(store, chunk)
+
+        rows += len(chunk)
+        print (f'{rows} positions merged.')
+    close_store(store)
+
+    return counts, sample, sizes
+
+# Pair the strands chunk by chunk into a columnar store, then normalize the 
+# store in place. With stored statistics the input is passed over once. Peak 
+# memory follows the chunk size. 
+def stream(arguments, fold_change, folder, statistics = None):
+    start = start_time('Reading and merging IPD file in chunks.')
+    chunks = read_chunks(arguments.ipd, arguments.chunk_size)
+    counts, sample, sizes = ingest(chunks, fold_change, folder, statistics, arguments.compact)
     end_time(start)
+    if arguments.compact:
+        report_savings(sizes)
+
+    if statistics is None:
+        statistics = sample
+        start = start_time('Normalizing output in chunks.')
+        normalize_store(folder, moments(statistics), arguments.chunk_size)
+        end_time(start)
+
+    return counts, statistics
+
+# Reference name of a line of the IPD file, or None past the last line. 
+def line_reference(line, column):
+    fields = line.rstrip(b'\r\n').split(b',')
+    if len(fields) <= column:
+        return None
+    return fields[column].strip(b'"').decode()
+
+# Start and reference name of the first line of the IPD file that starts at 
+# or after the offset. 
+def line_after(infile, offset, data_start, size, column):
+    if offset <= data_start:
+        offset = data_start
+    else:
+        infile.seek(offset - 1)
+        infile.readline()
+        offset = infile.tell()
+    if offset >= size:
+        return size, None
+    infile.seek(offset)
+
+    return offset, line_reference(infile.readline(), column)
+
+# Byte range of the rows of each chromosome in the IPD file, in file order, 
+# and the column names of the header. The end of each chromosome is found by 
+# bisecting the file for the first line of another reference, so only a few 
+# lines per chromosome are read. Assumes the rows of a chromosome are 
+# contiguous, as ipdSummary writes them. 
+def chromosome_ranges(filename):
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as infile:
+        header = infile.readline()
+        columns = [name.strip('"') for name in header.decode().strip().split(',')]
+        column = columns.index('ref_name')
+        data_start = infile.tell()
+
+        ranges = {}
+        start, chromosome = line_after(infile, data_start, data_start, size, column)
+        while chromosome is not None:
+            if chromosome in ranges:
+                raise ValueError(f'Rows of {chromosome} are not contiguous in {filename}.')
+            lower, upper = start + 1, size
+            while lower < upper:
+                middle = (lower + upper) // 2
+                if line_after(infile, middle, data_start, size, column)[1] != chromosome:
+                    upper = middle
+                else:
+                    lower = middle + 1
+            end, following = line_after(infile, lower, data_start, size, column)
+            ranges[chromosome] = (start, end)
+            start, chromosome = end, following
+
+    return ranges, columns
+
+# Read the rows of one chromosome from its byte range of the IPD file, whole 
+# or in chunks of rows that keep positions whole. Chunked reads stop at the 
+# first row of another chromosome. 
+def read_range(filename, chromosome, start, end, columns, chunk_size = None):
+    options = dict(ipd_options, header = None, names = columns)
+    with open(filename, 'rb') as infile:
+        infile.seek(start)
+        if not chunk_size:
+            yield pd.read_csv(io.BytesIO(infile.read(end - start)), **options)
+            return
+
+        def chunks():
+            for chunk in pd.read_csv(infile, chunksize = chunk_size, **options):
+                inside = (chunk['ref_name'].astype(str) == chromosome).values
+                if inside.any():
+                    yield chunk[inside]
+                if not inside.all():
+                    return
+
+        for chunk in hold_positions(chunks()):
+            if len(chunk):
+                yield chunk
+
+# Write the histogram counts, statistics and sizes of a store next to it. 
+def save_summary(folder, counts, sample, sizes):
+    summary = {
+        'counts': {index: values.tolist() for index, values in counts.items()},
+        'statistics': sample,
+        'sizes': sizes
+    }
+
+    with open(os.path.join(folder, 'summary.json'), 'w') as outfile:
+        json.dump(summary, outfile)
+
+# Read the summary written by save_summary. 
+def load_summary(folder):
+    with open(os.path.join(folder, 'summary.json')) as infile:
+        summary = json.load(infile)
+
+    counts = {index: np.array(values) for index, values in summary['counts'].items()}
+    return counts, summary['statistics'], summary['sizes']
+
+# Pair the strands of one chromosome's byte range of the IPD file into its 
+# own store and summarize it. Runs in a worker process, which parses only its 
+# own range. 
+def process_range(task):
+    filename, chromosome, (start, end), columns, folder, fold_change, statistics, chunk_size, compact_schema = task
+    chunks = read_range(filename, chromosome, start, end, columns, chunk_size)
+    counts, sample, sizes = ingest(chunks, fold_change, folder, statistics, compact_schema)
+    save_summary(folder, counts, sample, sizes)
 
-    # Encode bases. 
-    start = start_time('Encoding bases.')
-    top_encoding = pd.get_dummies(top_strand['top_base'], prefix = 'top')
-    bottom_encoding = pd.get_dummies(bottom_strand['bottom_base'], prefix = 'bottom')
+# Bump to invalidate cached chromosomes when the pairing changes. 
+cache_version = 1
 
-    # Merge encodings.
-    top_strand = pd.merge(top_strand, top_encoding, on = ['chromosome', 'position'])
-    bottom_strand = pd.merge(bottom_strand, bottom_encoding, on = ['chromosome', 'position'])
+# SHA-256 digest of a byte range of a file, read in blocks. 
+def range_digest(filename, start, end):
+    hasher = hashlib.sha256()
+    with open(filename, 'rb') as infile:
+        infile.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            block = infile.read(min(1 << 20, remaining))
+            if not block:
+                break
+            hasher.update(block)
+            remaining -= len(block)
 
-    # Drop base column.
-    top_strand = top_strand.drop(columns = 'top_base')
-    bottom_strand = bottom_strand.drop(columns = 'bottom_base')
+    return hasher.hexdigest()
+
+# Cache key of one chromosome: the digest of its byte range of the IPD file, 
+# the header, its fold change and the parameters that change the paired 
+# table. 
+def cache_key(filename, byte_range, columns, fold_change, compact_schema):
+    parameters = {
+        'version': cache_version,
+        'compact': compact_schema,
+        'columns': ipd_options['usecols']
+    }
+
+    hasher = hashlib.sha256()
+    hasher.update(json.dumps(parameters).encode())
+    hasher.update(json.dumps(columns).encode())
+    hasher.update(range_digest(filename, *byte_range).encode())
+    if fold_change is not None:
+        for chromosome, arrays in fold_change.items():
+            hasher.update(chromosome.encode())
+            for array in arrays:
+                hasher.update(np.ascontiguousarray(array).tobytes())
+
+    return hasher.hexdigest()
+
+# Move the chromosomes of several stores into one store. 
+def merge_stores(parts, folder):
+    store = open_store(folder)
+    for part in parts:
+        manifest = read_manifest(part)
+        if manifest['columns'] is None:
+            continue
+        if store['columns'] is None:
+            store['columns'] = manifest['columns']
+
+        for entry in manifest['chromosomes']:
+            current = dict(entry, folder = str(len(store['chromosomes'])))
+            shutil.move(
+                os.path.join(part, entry['folder']), 
+                os.path.join(folder, current['folder']))
+            store['chromosomes'].append(current)
+    close_store(store)
+
+# Find the byte range of each chromosome in the IPD file and pair, count and 
+# normalize each chromosome in a pool of worker processes that parse only 
+# their own range. The statistics of the workers are merged before 
+# normalization, so every chromosome is normalized with the genome-wide 
+# statistics. With the cache, chromosomes are paired into data/interm/cache 
+# under the digest of their byte range before normalization, and cached 
+# ranges are never parsed. 
+def parallel(arguments, fold_change, folder, statistics = None):
+    chunk_size = arguments.chunk_size or default_chunk_size
+    cache_folder = os.path.join(os.path.dirname(folder), 'cache')
+
+    start = start_time('Finding chromosomes in IPD file.')
+    ranges, columns = chromosome_ranges(arguments.ipd)
     end_time(start)
 
-    # Merge the top strand and bottom strand and ChIP if present. 
-    start = start_time('Merging files.')
-    ipd = pd.merge(top_strand, bottom_strand, on = ['chromosome', 'position'])
+    if arguments.cache:
+        start = start_time('Looking up chromosomes in the cache.')
+
+    tasks = []
+    sources = []
+    parts = []
+    for i, (chromosome, byte_range) in enumerate(ranges.items()):
+        part = os.path.join(f'{folder}.parts', str(i))
+        current = None
+        if fold_change is not None:
+            current = {chromosome: fold_change.get(chromosome, (np.zeros(0, dtype = np.int64),) * 2 + (np.zeros(0),))}
+
+        if arguments.cache:
+            source = os.path.join(cache_folder, cache_key(arguments.ipd, byte_range, columns, current, arguments.compact))
+            if not os.path.exists(os.path.join(source, 'summary.json')):
+                tasks.append((arguments.ipd, chromosome, byte_range, columns, source, current, None, arguments.chunk_size, arguments.compact))
+        else:
+            source = part
+            tasks.append((arguments.ipd, chromosome, byte_range, columns, part, current, statistics, arguments.chunk_size, arguments.compact))
+        sources.append(source)
+        parts.append(part)
+
+    if arguments.cache:
+        end_time(start)
+        print (f'{len(ranges) - len(tasks)} of {len(ranges)} chromosomes found in the cache.')
+
+    with Pool(arguments.jobs) as pool:
+        if tasks:
+            start = start_time(f'Merging {len(tasks)} chromosomes with {arguments.jobs} processes.')
+            pool.map(process_range, tasks)
+            end_time(start)
+
+        counts = {}
+        sample = {}
+        sizes = [0, 0]
+        for source, part in zip(sources, parts):
+            current_counts, current_sample, current_sizes = load_summary(source)
+            sizes = [sizes[0] + current_sizes[0], sizes[1] + current_sizes[1]]
+            for index, values in current_counts.items():
+                counts[index] = counts.get(index, 0) + values
+            for column, current in current_sample.items():
+                sample[column] = combine(sample.get(column, {'count': 0, 'mean': 0.0, 'm2': 0.0}), current)
+
+            # Cached chromosomes are copied so the cache stays unnormalized. 
+            if source != part:
+                shutil.copytree(source, part)
+
+        if arguments.cache or (statistics is None):
+            if statistics is None:
+                statistics = sample
+            start = start_time('Normalizing output.')
+            averages = moments(statistics)
+            pool.starmap(normalize_store, [(part, averages, chunk_size) for part in parts])
+            end_time(start)
+
+    merge_stores(parts, folder)
+    shutil.rmtree(f'{folder}.parts')
+    if arguments.compact:
+        report_savings(sizes)
+
+    return counts, statistics
+
+def main():
+    total_start = start_time()
+    # Get argparse arguments. 
+    arguments = setup()
+
+    # Only draw the report of an earlier run. 
+    if arguments.plot_counts:
+        start = start_time('Plotting histograms.')
+        filename = f'{os.path.splitext(arguments.plot_counts)[0]}.pdf'
+        plot(load_counts(arguments.plot_counts), filename)
+        end_time(start)
+        return
+    
+    # Normalize with stored statistics if given. 
+    statistics = None
+    if arguments.statistics:
+        statistics = load_statistics(arguments.statistics)
+
+    # If there is ChIP data: 
+    fold_change = None
     if arguments.fold_change:
-        ipd = pd.merge(ipd, fold_change, on = ['chromosome', 'position'])
-    end_time(start)
+        start = start_time('Reading fold change file.')
+        extension = os.path.splitext(arguments.fold_change)[1].lower()
+        if (arguments.fold_change_format == 'intervals') or \
+           ((arguments.fold_change_format == 'auto') and (extension in ['.bedgraph', '.bdg'])):
+            fold_change = read_fold_change_intervals(arguments.fold_change, arguments.fold_change_offset)
+        else:
+            fold_change = read_fold_change(arguments.fold_change)
+        end_time(start)
 
-    # Plot the histograms of each feature. 
-    start = start_time('Plotting histograms.')
     project_folder = project_path()
     reports_folder = os.path.join(project_folder, 'reports')
+    data_folder = os.path.join(project_folder, 'data')
+    interm_folder = os.path.join(data_folder, 'interm')
 
     if arguments.prefix:
-        filename = os.path.join(reports_folder, f'{arguments.prefix}_histograms.pdf')
+        report_filename = os.path.join(reports_folder, f'{arguments.prefix}_histograms.pdf')
+        folder = os.path.join(interm_folder, f'{arguments.prefix}_data')
     else:
-        filename = os.path.join(reports_folder, 'histograms.pdf')
+        report_filename = os.path.join(reports_folder, 'histograms.pdf')
+        folder = os.path.join(interm_folder, 'data')
+    filename = f'{folder}.h5'
 
-    plot(ipd, filename, arguments.fold_change)
-    end_time(start)
+    if (arguments.jobs > 1) or arguments.cache or arguments.chunk_size:
+        # HDF output is converted from a temporary store. 
+        target = folder
+        if arguments.format == 'hdf':
+            target = f'{folder}.tmp'
 
-    # Normalize ipd and output to HDF file. 
-    start = start_time('Writing output.')
-    ipd = normalize(ipd).round(4)
+        if (arguments.jobs > 1) or arguments.cache:
+            counts, statistics = parallel(arguments, fold_change, target, statistics)
+        else:
+            counts, statistics = stream(arguments, fold_change, target, statistics)
 
-    data_folder = os.path.join(project_folder, 'data')
-    interm_folder = os.path.join(data_folder, 'interm')
-    if arguments.prefix:
-        filename = os.path.join(interm_folder, f'{arguments.prefix}_data.h5')
+        if arguments.format == 'hdf':
+            start = start_time('Writing HDF file.')
+            store_to_hdf(target, filename)
+            shutil.rmtree(target)
+            end_time(start)
     else:
-        filename = os.path.join(interm_folder, 'data.h5')
+        # Load the IPD data. 
+        start = start_time('Reading IPD file.')
+        ipd = pd.read_csv(arguments.ipd, **ipd_options)
+        end_time(start)
+
+        start = start_time('Merging files.')
+        ipd = pair_strands(ipd, fold_change)
+        end_time(start)
+
+        counts = histogram(ipd)
+        if statistics is None:
+            statistics = accumulate(ipd)
+
+        # Normalize ipd and write the output. 
+        start = start_time('Writing output.')
+        if arguments.compact:
+            ipd = raw_coverage(ipd)
+        ipd = normalize(ipd, moments(statistics)).round(4)
+        if arguments.compact:
+            before = table_bytes(ipd.drop(columns = ['top_coverage_raw', 'bottom_coverage_raw']))
+            ipd = compact(ipd)
+            report_savings([before, table_bytes(ipd)])
+        if arguments.format == 'hdf':
+            ipd.to_hdf(filename, key = 'data', format = 'table')
+        else:
+            store = open_store(folder)
+            append_store(store, ipd)
+            close_store(store)
+        end_time(start)
+
+    # Keep the statistics the output was normalized with next to it. 
+    save_statistics(statistics, f'{folder}_statistics.json')
+
+    # Save the histogram counts of each feature and plot them. 
+    save_counts(counts, f'{os.path.splitext(report_filename)[0]}.json')
+    if not arguments.skip_plot:
+        start = start_time('Plotting histograms.')
+        plot(counts, report_filename)
+        end_time(start)
 
-    ipd.to_hdf(filename, 'data', format = 'table')
-    end_time(start)
     total_time = end_time(total_start, True)
     print (f'{total_time} elapsed in total.')
 
@@ -1,5 +1,9 @@
+from multiprocessing import shared_memory, resource_tracker, Pool
+import pandas as pd
 import numpy as np
 import argparse
+import shutil
+import json
 import time
 import os
 
@@ -15,7 +19,7 @@ def setup():
         '-i', 
         '--infile', 
         required = True,
-        help = 'Input file.')
+        help = 'Input columnar store folder or HDF file.')
 
     parser.add_argument(
         '-w', 
@@ -32,7 +36,8 @@ def setup():
                    'top_G', 
                    'top_ipd', 
                    'bottom_ipd'],
-        help = 'List of columns to include as features.')
+        nargs = '+',
+        help = 'List of stored or derived columns to include as features.')
 
     parser.add_argument(
         '--ipd',
@@ -53,6 +58,19 @@ def setup():
         type = int,
         help = 'Max number of examples from each class.')
 
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        default = 1,
+        type = int,
+        help = 'Number of processes used to extract windows.')
+
+    parser.add_argument(
+        '--seed',
+        default = 0,
+        type = int,
+        help = 'Random seed for sampling and shuffling examples.')
+
     parser.add_argument(
         '--save-classes',
         action='store_true',
@@ -64,81 +82,668 @@ def setup():
         '--prefix', 
         default = False,
         help = 'Output prefix.')
+
+    parser.add_argument(
+        '--shard-size',
+        default = 0,
+        type = int,
+        help = 'Write the output in shards of this many windows, with their labels for training. Writes one output when 0.')
+
+    parser.add_argument(
+        '--output-format',
+        default = 'npy',
+        choices = ['npy', 'json'],
+        help = 'Write memory-mappable .npy arrays with a manifest, or the old JSON file.')
     
-    return parser.parse_args()
+    arguments = parser.parse_args()
+    if arguments.shard_size and arguments.output_format == 'json':
+        parser.error('--shard-size writes .npy shards and cannot be used with --output-format json')
+
+    return arguments
+
+# Read the manifest of a columnar store written by preprocessing. 
+def read_manifest(folder):
+    with open(os.path.join(folder, 'manifest.json')) as infile:
+        return json.load(infile)
+
+# Memory-map one column of one chromosome of a columnar store. 
+def map_column(folder, manifest, entry, column):
+    dtype = np.dtype(manifest['columns'][column])
+    if entry['length'] == 0:
+        return np.zeros(0, dtype = dtype)
+    filename = os.path.join(folder, entry['folder'], f'{column}.bin')
+    return np.memmap(filename, dtype = dtype, mode = 'r', shape = (entry['length'],))
+
+# Load the selected columns of a columnar store into a table indexed by 
+# chromosome and position. Unselected columns are never read. 
+def read_store(folder, columns = None):
+    manifest = read_manifest(folder)
+    if columns is None:
+        columns = [column for column in manifest['columns'] if column != 'position']
+
+    names = [entry['name'] for entry in manifest['chromosomes']]
+    codes = []
+    positions = []
+    arrays = {column: [] for column in columns}
+    for i, entry in enumerate(manifest['chromosomes']):
+        codes.append(np.full(entry['length'], i, dtype = np.int32))
+        positions.append(map_column(folder, manifest, entry, 'position'))
+        for column in columns:
+            arrays[column].append(map_column(folder, manifest, entry, column))
+
+    index = pd.MultiIndex.from_arrays([
+            pd.Categorical.from_codes(np.concatenate(codes), names), 
+            np.concatenate(positions)
+        ], 
+        names = ['chromosome', 'position'])
+    arrays = {column: np.concatenate(arrays[column]) for column in columns}
+
+    return pd.DataFrame(arrays, index = index, columns = columns)
+
+# Rows on each side of a position used for the local z-score. 
+zscore_radius = 12
+
+# Derived features cached by (input file, chromosome, name) on first use. 
+derived_cache = {}
+
+# Mean and standard deviation of each normalized column, read from the 
+# statistics preprocessing saved next to the input. 
+def input_averages(filename):
+    key = (filename, 'averages')
+    if key not in derived_cache:
+        base = os.path.splitext(filename.rstrip(os.sep))[0]
+        with open(f'{base}_statistics.json') as infile:
+            statistics = json.load(infile)
+        averages = {}
+        for column, current in statistics.items():
+            averages[column] = (current['mean'], np.sqrt(current['m2'] / (current['count'] - 1)))
+        derived_cache[key] = averages
+
+    return derived_cache[key]
+
+# Z-score of each value against the values within the radius around it, 
+# computed with running sums over the chromosome. 
+def local_zscore(values, radius = zscore_radius):
+    values = np.asarray(values, dtype = np.float64)
+    sums = np.concatenate([[0], np.cumsum(values)])
+    squares = np.concatenate([[0], np.cumsum(np.square(values))])
+    rows = np.arange(len(values))
+    lower = np.maximum(rows - radius, 0)
+    upper = np.minimum(rows + radius + 1, len(values))
+    count = upper - lower
+    mean = (sums[upper] - sums[lower]) / count
+    variance = np.maximum((squares[upper] - squares[lower]) / count - np.square(mean), 0)
+    std = np.sqrt(variance)
 
-def sample(data, examples):
-    if len(data) <= examples:
-        return data.index.values
+    return np.divide(values - mean, std, out = np.zeros(len(values)), where = std > 0)
+
+# Difference between the top and bottom strand IPD. 
+def ipd_difference(arrays, filename):
+    return arrays['top_ipd'] - arrays['bottom_ipd']
+
+# Local z-score of the top strand IPD. 
+def top_ipd_zscore(arrays, filename):
+    return local_zscore(arrays['top_ipd'])
+
+# Local z-score of the bottom strand IPD. 
+def bottom_ipd_zscore(arrays, filename):
+    return local_zscore(arrays['bottom_ipd'])
+
+# Mean of the strand IPDs weighted by the raw coverage of each strand. The 
+# stored coverage is normalized, so it is converted back with the saved 
+# statistics. 
+def weighted_ipd(arrays, filename):
+    averages = input_averages(filename)
+    coverage = {}
+    for strand in ['top', 'bottom']:
+        mean, std = averages[f'{strand}_coverage']
+        coverage[strand] = np.maximum(arrays[f'{strand}_coverage'] * std + mean, 0)
+    total = coverage['top'] + coverage['bottom']
+    weighted = arrays['top_ipd'] * coverage['top'] + arrays['bottom_ipd'] * coverage['bottom']
+    average = (arrays['top_ipd'] + arrays['bottom_ipd']) / 2
+
+    return np.divide(weighted, total, out = average, where = total > 0)
+
+# Derived features that can be selected like stored columns: the stored 
+# columns each one needs and the function that computes it from the arrays 
+# of one chromosome. 
+derived_features = {
+    'ipd_difference': (['top_ipd', 'bottom_ipd'], ipd_difference),
+    'top_ipd_zscore': (['top_ipd'], top_ipd_zscore),
+    'bottom_ipd_zscore': (['bottom_ipd'], bottom_ipd_zscore),
+    'weighted_ipd': (['top_ipd', 'bottom_ipd', 'top_coverage', 'bottom_coverage'], weighted_ipd)
+}
+
+# The stored columns needed for the selected stored and derived columns. 
+def stored_columns(columns):
+    output = []
+    for column in columns:
+        if column in derived_features:
+            needed = derived_features[column][0]
+        else:
+            needed = [column]
+        for current in needed:
+            if current not in output:
+                output.append(current)
+
+    return output
+
+# Compute one derived feature for one chromosome, or return it from the 
+# cache. The arrays hold the stored columns of the chromosome sorted by 
+# position. 
+def derive(filename, chromosome, arrays, name):
+    key = (filename, chromosome, name)
+    if key not in derived_cache:
+        function = derived_features[name][1]
+        derived_cache[key] = np.asarray(function(arrays, filename), dtype = np.float64)
+
+    return derived_cache[key]
+
+# Drop the cached derived features of an input file, or of one chromosome of 
+# it, once they are no longer needed. 
+def release_derived(filename, chromosome = None):
+    for key in list(derived_cache):
+        if (len(key) == 3) and (key[0] == filename) and (chromosome in [None, key[1]]):
+            del derived_cache[key]
+
+# Add the selected derived columns to the data, computed chromosome by 
+# chromosome in position order. The table keeps the values, so each 
+# chromosome's cached features are dropped once they are copied in. 
+def add_derived(data, filename, columns):
+    derived = [column for column in columns if column in derived_features]
+    if not derived:
+        return data
+
+    needed = stored_columns(derived)
+    names, boundaries, positions, values = sorted_arrays(data, needed, np.float64)
+    order = np.lexsort((data.index.get_level_values(1).values, data.index.codes[0]))
+    output = np.zeros((len(data), len(derived)))
+    for i, name in enumerate(names):
+        lower, upper = boundaries[i], boundaries[i + 1]
+        if upper == lower:
+            continue
+        arrays = {column: values[lower:upper, j] for j, column in enumerate(needed)}
+        for j, column in enumerate(derived):
+            output[order[lower:upper], j] = derive(filename, name, arrays, column)
+        release_derived(filename, name)
+
+    for j, column in enumerate(derived):
+        data[column] = output[:, j]
+
+    return data
+
+# Load the selected columns from a columnar store folder or a HDF file. 
+# Derived columns are computed from the stored columns they need. 
+def read_data(filename, columns = None):
+    stored = columns
+    if columns is not None:
+        stored = stored_columns(columns)
+
+    if os.path.isdir(filename):
+        data = read_store(filename, stored)
     else:
-        return data.sample(examples).index.values
+        data = pd.read_hdf(filename, columns = stored)
+
+    if columns is None:
+        return data
+    return add_derived(data, filename, columns)[columns]
+
+# Read the selected columns of a columnar store or HDF table in blocks of 
+# rows as (chromosome, positions, values), with one column of values per 
+# selected column. Only one block is in memory at a time. 
+def read_blocks(filename, columns, size = 1000000):
+    if os.path.isdir(filename):
+        manifest = read_manifest(filename)
+        for entry in manifest['chromosomes']:
+            positions = map_column(filename, manifest, entry, 'position')
+            arrays = [map_column(filename, manifest, entry, column) for column in columns]
+            for i in range(0, entry['length'], size):
+                values = np.column_stack([array[i:i + size] for array in arrays]).astype(np.float64)
+                yield entry['name'], np.asarray(positions[i:i + size]), values
+        return
+
+    for chunk in pd.read_hdf(filename, columns = columns, chunksize = size):
+        chromosomes = chunk.index.get_level_values(0).astype(str).values
+        positions = chunk.index.get_level_values(1).values
+        values = chunk[columns].to_numpy(dtype = np.float64)
+        for chromosome in pd.unique(chromosomes):
+            selection = chromosomes == chromosome
+            yield chromosome, positions[selection], values[selection]
+
+# Sample up to the given number of (chromosome, position) pairs of each class 
+# uniformly in one pass over the blocks. classify maps a block of values to a 
+# class number per row (-1 for none). Every candidate gets a random key and 
+# each class keeps the candidates with the smallest keys, which is a reservoir 
+# sample, so memory depends on the number of examples and not on the data. 
+def reservoir_sample(blocks, classify, classes, examples, seed = None):
+    random = np.random.default_rng(seed)
+    reservoirs = []
+    for i in range(classes):
+        reservoirs.append((np.zeros(0), np.zeros(0, dtype = object), np.zeros(0, dtype = np.int64)))
+
+    for chromosome, positions, values in blocks:
+        labels = classify(values)
+        keys = random.random(len(positions))
+        for i in range(classes):
+            selection = labels == i
+            current_keys = np.concatenate([reservoirs[i][0], keys[selection]])
+            current_chromosomes = np.concatenate([reservoirs[i][1], np.full(selection.sum(), chromosome, dtype = object)])
+            current_positions = np.concatenate([reservoirs[i][2], positions[selection]])
+            if len(current_keys) > examples:
+                keep = np.argpartition(current_keys, examples)[:examples]
+                current_keys = current_keys[keep]
+                current_chromosomes = current_chromosomes[keep]
+                current_positions = current_positions[keep]
+            reservoirs[i] = (current_keys, current_chromosomes, current_positions)
 
-def windows(index, data, window, columns):
+    output = []
+    for keys, chromosomes, positions in reservoirs:
+        order = np.argsort(keys)
+        output.append(pd.MultiIndex.from_arrays([chromosomes[order], positions[order]]))
+
+    return output
+
+# Sort the data by chromosome and position and convert the selected columns 
+# to one single precision matrix with a column per feature. Returns the 
+# chromosome names, the row where each chromosome starts (and the end), the 
+# positions and the matrix. 
+def sorted_arrays(data, columns, dtype = np.float32):
+    codes = data.index.codes[0]
+    names = [str(name) for name in data.index.levels[0]]
+    positions = data.index.get_level_values(1).values
+    values = data[columns].to_numpy(dtype = dtype)
+
+    order = np.lexsort((positions, codes))
+    codes, positions, values = codes[order], positions[order], values[order]
+    boundaries = np.searchsorted(codes, np.arange(len(names) + 1))
+
+    return names, boundaries, positions, values
+
+# Split the selected columns of the data into contiguous arrays for each 
+# chromosome: the sorted positions and a matrix with one column per feature. 
+def chromosome_arrays(data, columns):
+    names, boundaries, positions, values = sorted_arrays(data, columns)
+
+    arrays = {}
+    for i, name in enumerate(names):
+        lower, upper = boundaries[i], boundaries[i + 1]
+        if upper > lower:
+            arrays[name] = (positions[lower:upper], values[lower:upper])
+
+    return arrays
+
+# Dense coordinate index of one chromosome's sorted, unique positions: the 
+# first position, a mask of which positions between the first and last are 
+# present, and a prefix sum of the missing ones (gaps[i] counts the missing 
+# positions before offset i). 
+def coordinate_index(positions):
+    first = positions[0]
+    valid = np.zeros(positions[-1] - first + 1, dtype = bool)
+    valid[positions - first] = True
+    gaps = np.zeros(len(valid) + 1, dtype = np.int32)
+    np.cumsum(~valid, out = gaps[1:])
+
+    return first, valid, gaps
+
+# Whether the window starting at each lower bound has every position, and the 
+# row of its first position. Both are O(1) per window. 
+def complete_windows(coordinates, lower_bound, window):
+    first, valid, gaps = coordinates
+    start = lower_bound - first
+    end = start + window
+    complete = (start >= 0) & (end <= len(valid))
+    complete[complete] = gaps[end[complete]] == gaps[start[complete]]
+
+    rows = np.zeros(len(start), dtype = np.int64)
+    rows[complete] = start[complete] - gaps[start[complete]]
+    return complete, rows
+
+# Lower bounds of every complete window of one chromosome. 
+def window_starts(coordinates, window):
+    first, valid, gaps = coordinates
+    if len(valid) < window:
+        return np.zeros(0, dtype = np.int64)
+    return np.flatnonzero(gaps[window:] == gaps[:-window]) + first
+
+# Index of every (chromosome, position) whose window is complete. 
+def valid_centers(data, window):
     radius = int(window/2)
-    features = []
-    positions = []
+    chromosomes = []
+    centers = []
+    for chromosome, (positions, values) in chromosome_arrays(data, []).items():
+        current = window_starts(coordinate_index(positions), window) + radius
+        chromosomes.append(np.repeat(chromosome, len(current)))
+        centers.append(current)
 
-    k = 0
-    for i in range(len(index)):
-        chromosome = index[i][0]
-        position = index[i][1]
-        lower_bound = position - radius
-        upper_bound = position + radius 
+    if not centers:
+        return pd.MultiIndex.from_arrays([[], []])
+    return pd.MultiIndex.from_arrays([np.concatenate(chromosomes), np.concatenate(centers)])
 
-        try:
-            feature_vector = {}
+# Feature vectors of the windows whose first position is at each row of a 
+# chromosome's value matrix, one column after another. 
+def gather(values, rows, window):
+    rows = rows[:, None] + np.arange(window)
+    return values[rows].transpose(0, 2, 1).reshape(len(rows), values.shape[1] * window)
+
+# Read the selected columns one chromosome at a time as (chromosome, 
+# positions, values). A columnar store is read one chromosome at a time, a HDF 
+# file is read whole. Derived features are dropped from the cache once their 
+# chromosome is read, so memory does not grow with the genome. 
+def read_chromosomes(filename, columns):
+    if os.path.isdir(filename):
+        manifest = read_manifest(filename)
+        for entry in manifest['chromosomes']:
+            if entry['length'] == 0:
+                continue
+            positions = np.asarray(map_column(filename, manifest, entry, 'position'))
+            arrays = {}
+            for column in stored_columns(columns):
+                arrays[column] = np.asarray(map_column(filename, manifest, entry, column), dtype = np.float64)
+            values = []
             for column in columns:
-                feature_vector[column] = []
+                if column in derived_features:
+                    values.append(derive(filename, entry['name'], arrays, column))
+                else:
+                    values.append(arrays[column])
+            values = np.column_stack(values).astype(np.float32)
+            release_derived(filename, entry['name'])
+            yield entry['name'], positions, values
+        return
 
-            coordinates = list(range(lower_bound, upper_bound))
-            for j in coordinates:
-                selection =  data.loc[chromosome, j]
-                for column in columns:
-                    feature_vector[column].append(selection[column])
+    data = read_data(filename, columns)
+    for chromosome, (positions, values) in chromosome_arrays(data, columns).items():
+        yield chromosome, positions, values
 
-            concatenation = []
-            for column in columns:
-                concatenation += feature_vector[column]
-            features.append(concatenation)
+# Every complete window of one chromosome, in blocks of at most the given 
+# number of windows, as (features, positions). With an extractor the values 
+# are handed to it and the blocks are gathered by its workers. 
+def chromosome_windows(positions, values, window, size, extractor = None):
+    coordinates = coordinate_index(positions)
+    first, valid, gaps = coordinates
+    starts = window_starts(coordinates, window)
+    rows = starts - first - gaps[starts - first]
+    if extractor is not None:
+        set_values(extractor, values)
+    for i in range(0, len(starts), size):
+        current = starts[i:i + size]
+        if extractor is None:
+            features = gather(values, rows[i:i + size], window)
+        else:
+            features = gather_windows(extractor, rows[i:i + size], window)
+        yield features, current[:, None] + np.arange(window)
+
+# Shared memory blocks attached by a worker process, by key. 
+shared = {}
+
+# Attach the shared memory blocks described by (name, shape, dtype) in a 
+# worker process. Blocks already attached under a key are kept while the 
+# name is the same and closed when it changes. 
+def attach(specifications):
+    for key, (name, shape, dtype) in specifications.items():
+        if key in shared:
+            if shared[key][0].name == name:
+                continue
+            shared[key][0].close()
+        block = shared_memory.SharedMemory(name = name)
+        shared[key] = (block, np.ndarray(shape, dtype = dtype, buffer = block.buf))
+
+# Fill one slice of the shared output with the windows starting at the shared 
+# rows. Runs in a worker process. 
+def fill(task):
+    specifications, lower, upper, window = task
+    attach(specifications)
+    values = shared['values'][1]
+    starts = shared['starts'][1]
+    features = shared['features'][1]
+    features[lower:upper] = gather(values, starts[lower:upper], window)
+
+# Replace the shared memory block under a key with a new one of the given 
+# shape and type. 
+def create_block(extractor, key, shape, dtype):
+    release_block(extractor, key)
+    dtype = np.dtype(dtype)
+    block = shared_memory.SharedMemory(create = True, size = max(int(np.prod(shape)) * dtype.itemsize, 1))
+    extractor['blocks'][key] = (block, np.ndarray(shape, dtype = dtype, buffer = block.buf))
+
+    return extractor['blocks'][key][1]
+
+# Close and remove the shared memory block under a key. 
+def release_block(extractor, key):
+    if key in extractor['blocks']:
+        block, view = extractor['blocks'].pop(key)
+        del view
+        block.close()
+        block.unlink()
+
+# Open a window extractor for one run. With more than one job it holds a 
+# pool of workers, created once, and the value matrix in shared memory. With 
+# data, the selected columns are sorted into one matrix once; without, values 
+# are set chromosome by chromosome with set_values. 
+def open_windows(data = None, columns = None, jobs = 1):
+    extractor = {'pool': None, 'jobs': jobs, 'blocks': {}, 'values': None}
+    if jobs > 1:
+        # Workers share the resource tracker of this process only if it runs 
+        # before they start, otherwise each one reports the blocks as leaked. 
+        resource_tracker.ensure_running()
+        extractor['pool'] = Pool(jobs)
+    if data is not None:
+        names, boundaries, positions, values = sorted_arrays(data, columns)
+        extractor['names'] = names
+        extractor['boundaries'] = boundaries
+        extractor['positions'] = positions
+        set_values(extractor, values)
 
-            positions.append(coordinates) 
+    return extractor
 
-        except TypeError:
-            k += 1
-            
-        if (i % 10000 == 0) and (i > 0):
-            print (f'{i} examples created.')
+# Set the value matrix windows are gathered from, copying it to shared 
+# memory when there are workers. 
+def set_values(extractor, values):
+    extractor['values'] = values
+    if extractor['pool'] is not None:
+        create_block(extractor, 'values', values.shape, values.dtype)[...] = values
 
-    print (f'Skipped {k} examples because of missing values.')
+# Stop the workers and remove the shared memory blocks. 
+def close_windows(extractor):
+    if extractor['pool'] is not None:
+        extractor['pool'].close()
+        extractor['pool'].join()
+    for key in list(extractor['blocks']):
+        release_block(extractor, key)
+
+# Gather the windows starting at each row of the value matrix. With workers 
+# the rows and the output are placed in shared memory next to the matrix and 
+# each worker fills a disjoint slice of the output. Only block names and 
+# slice bounds are sent to the workers. 
+def gather_windows(extractor, starts, window):
+    values = extractor['values']
+    if (extractor['pool'] is None) or (len(starts) == 0):
+        return gather(values, starts, window)
+
+    create_block(extractor, 'starts', starts.shape, starts.dtype)[...] = starts
+    create_block(extractor, 'features', (len(starts), values.shape[1] * window), values.dtype)
+    specifications = {}
+    for key, (block, view) in extractor['blocks'].items():
+        specifications[key] = (block.name, view.shape, view.dtype.str)
+
+    bounds = np.linspace(0, len(starts), extractor['jobs'] * 4 + 1).astype(int)
+    tasks = [(specifications, bounds[i], bounds[i + 1], window) for i in range(len(bounds) - 1)]
+    extractor['pool'].map(fill, tasks)
+
+    return np.array(extractor['blocks']['features'][1])
+
+# Build the feature vector of the window around each (chromosome, position) 
+# in the index from the sorted data of an extractor, gathering all windows 
+# with one fancy index, so no table lookups happen per base. A vector holds 
+# the window of the first column, then the second, and so on. Windows with 
+# missing positions are skipped. 
+def windows(index, extractor, window):
+    radius = int(window/2)
+    if not isinstance(index, pd.MultiIndex):
+        index = pd.MultiIndex.from_tuples(index)
+    chromosomes = index.get_level_values(0).astype(str).values
+    centers = index.get_level_values(1).values.astype(np.int64)
+
+    names, boundaries, positions = extractor['names'], extractor['boundaries'], extractor['positions']
+    starts = np.zeros(len(index), dtype = np.int64)
+    complete = np.zeros(len(index), dtype = bool)
+
+    for chromosome in pd.unique(chromosomes):
+        if chromosome not in names:
+            continue
+        lower, upper = boundaries[names.index(chromosome)], boundaries[names.index(chromosome) + 1]
+        if upper == lower:
+            continue
+        selection = np.flatnonzero(chromosomes == chromosome)
+        valid, start = complete_windows(coordinate_index(positions[lower:upper]), centers[selection] - radius, window)
+
+        starts[selection[valid]] = lower + start[valid]
+        complete[selection[valid]] = True
+
+    features = gather_windows(extractor, starts[complete], window)
+    positions = centers[complete][:, None] - radius + np.arange(window)
+
+    print (f'Skipped {(~complete).sum()} examples because of missing values.')
     return features, positions
 
-# Only works if the first four columns are one-hot encodes of top strand 
-# sequence. (Default) 
-def create_fasta(vectors, window):
-    sequences = []
-    bases = np.array(['A', 'T', 'C', 'G'])
+# Write feature vectors with their column labels, window positions and 
+# optional labels. The npy format is a folder with one .npy array each and a 
+# manifest.json holding the column labels and any extra fields, which loaders 
+# can memory-map. The json format writes the same fields to one JSON file. 
+def save_features(filename, columns, vectors, positions, labels = None, output_format = 'npy', extra = None):
+    if output_format == 'json':
+        data = dict(extra or {})
+        data['columns'] = columns
+        data['vectors'] = np.asarray(vectors).tolist()
+        data['positions'] = np.asarray(positions).tolist()
+        if labels is not None:
+            data['labels'] = np.asarray(labels).tolist()
 
-    for example in vectors:
-        current = []
-        for i in range(window):
-            index = np.array([example[i], 
-                              example[i + window],
-                              example[i + (window * 2)],
-                              example[i + (window * 3)]]
-                              , dtype = bool)
-            current += list(bases[index])
+        with open(f'{filename}.json', 'w') as outfile:
+            json.dump(data, outfile, indent = 4)
+        return
 
-        sequences.append(current)
+    os.makedirs(filename, exist_ok = True)
+    np.save(os.path.join(filename, 'vectors.npy'), np.asarray(vectors))
+    np.save(os.path.join(filename, 'positions.npy'), np.asarray(positions))
+    if labels is not None:
+        np.save(os.path.join(filename, 'labels.npy'), np.asarray(labels))
+    elif os.path.exists(os.path.join(filename, 'labels.npy')):
+        os.remove(os.path.join(filename, 'labels.npy'))
 
-    output = ''
-    for i in range(len(sequences)):
-        header = f'>{i}\n'
-        sequence = ''.join(sequences[i])
-        line = f'{sequence}\n' 
+    manifest = dict(extra or {})
+    manifest['format'] = 'features'
+    manifest['version'] = 1
+    manifest['columns'] = columns
+    with open(os.path.join(filename, 'manifest.json'), 'w') as outfile:
+        json.dump(manifest, outfile, indent = 4)
 
-        output += header + line
+# Open a folder for feature vectors written in shards of a fixed number of 
+# windows. Each shard is a folder of .npy arrays in the format of 
+# save_features, with labels when the windows are appended with them, and the 
+# manifest lists the shards written so far, so readers can start on the first 
+# shards before the last one is written. 
+def open_shards(folder, columns, size):
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.makedirs(folder)
 
-    return output
+    shards = {
+        'folder': folder,
+        'columns': columns,
+        'size': size,
+        'features': [],
+        'positions': [],
+        'labels': [],
+        'buffered': 0,
+        'shards': []
+    }
+    write_shard_manifest(shards, False)
+
+    return shards
+
+# Write the manifest of a sharded output. 
+def write_shard_manifest(shards, complete):
+    manifest = {
+        'format': 'shards',
+        'version': 1,
+        'columns': shards['columns'],
+        'shard_size': shards['size'],
+        'shards': shards['shards'],
+        'complete': complete
+    }
+
+    filename = os.path.join(shards['folder'], 'manifest.json')
+    with open(f'{filename}.tmp', 'w') as outfile:
+        json.dump(manifest, outfile, indent = 4)
+    os.replace(f'{filename}.tmp', filename)
+
+# Write the buffered windows as one shard. 
+def flush_shard(shards):
+    features = np.concatenate(shards['features'])
+    positions = np.concatenate(shards['positions'])
+    labels = None
+    if shards['labels']:
+        labels = np.concatenate(shards['labels'])
+    name = f'shard_{len(shards["shards"]):05d}'
+    save_features(
+        os.path.join(shards['folder'], name), 
+        shards['columns'], 
+        features, 
+        positions,
+        labels)
+
+    shards['shards'].append({'name': name, 'length': len(features)})
+    shards['features'] = []
+    shards['positions'] = []
+    shards['labels'] = []
+    shards['buffered'] = 0
+    write_shard_manifest(shards, False)
+    print (f'{sum(shard["length"] for shard in shards["shards"])} windows written.')
+
+# Add windows to a sharded output, writing every shard that fills up. Labels 
+# are given with every call or with none of them. 
+def append_shards(shards, features, positions, labels = None):
+    while len(features):
+        space = shards['size'] - shards['buffered']
+        shards['features'].append(features[:space])
+        shards['positions'].append(positions[:space])
+        if labels is not None:
+            shards['labels'].append(labels[:space])
+            labels = labels[space:]
+        shards['buffered'] += len(features[:space])
+        features, positions = features[space:], positions[space:]
+        if shards['buffered'] == shards['size']:
+            flush_shard(shards)
+
+# Write the last partial shard and mark the output complete. 
+def close_shards(shards):
+    if shards['buffered']:
+        flush_shard(shards)
+    write_shard_manifest(shards, True)
+
+# Write feature vectors that are already in memory with their labels as a 
+# sharded output, so training can stream them shard by shard. 
+def save_shards(filename, columns, vectors, positions, labels, size):
+    shards = open_shards(filename, columns, size)
+    append_shards(shards, vectors, positions, labels)
+    close_shards(shards)
+
+# Write the top strand sequence of each vector to a FASTA file, decoding a 
+# block of vectors at a time with argmax over its one-hot columns. Positions 
+# without a base are written as N. Only works if the first four columns are 
+# one-hot encodes of top strand sequence. (Default) 
+def write_fasta(filename, vectors, window, size = 100000):
+    bases = np.frombuffer(b'ATCGN', dtype = np.uint8)
+
+    with open(filename, 'w') as outfile:
+        for i in range(0, len(vectors), size):
+            block = np.asarray(vectors[i:i + size])[:, :window * 4].reshape(-1, 4, window)
+            codes = block.argmax(axis = 1)
+            codes[block.max(axis = 1) <= 0] = 4
+            sequences = np.ascontiguousarray(bases[codes]).view(f'S{window}').ravel()
+
+            records = [f'>{i + j}\n{sequence.decode()}\n' for j, sequence in enumerate(sequences)]
+            outfile.write(''.join(records))
 
 # Start the timer. 
 def start_time(string = None):
@@ -1,37 +1,46 @@
 import data_extraction
-import pandas as pd
 import numpy as np
-import json
 import os
 
+# Confusion class of each row of (top_ipd, bottom_ipd, fold_change) values: 
+# 0 true positive, 1 false negative, 2 true negative, 3 false positive and -1 
+# for values on a threshold. 
+def confusion_classes(values, ipd, fold_change):
+    peak = (values[:, 0] > ipd) | (values[:, 1] > ipd)
+    background = (values[:, 0] < ipd) & (values[:, 1] < ipd)
+    enriched = values[:, 2] > fold_change
+    depleted = values[:, 2] < fold_change
+
+    classes = np.full(len(values), -1)
+    classes[peak & enriched] = 0
+    classes[background & enriched] = 1
+    classes[background & depleted] = 2
+    classes[peak & depleted] = 3
+
+    return classes
+
 def main():
     total_start = data_extraction.start_time()
     arguments = data_extraction.setup()
 
-    start = data_extraction.start_time('Reading data.')
-    data = pd.read_hdf(arguments.infile, columns = ['fold_change'] + arguments.columns)
+    start = data_extraction.start_time('Sampling data.')
+    blocks = data_extraction.read_blocks(arguments.infile, ['top_ipd', 'bottom_ipd', 'fold_change'])
+    classify = lambda values: confusion_classes(values, arguments.ipd, arguments.fold_change)
+    samples = data_extraction.reservoir_sample(blocks, classify, 4, arguments.examples, arguments.seed)
+    true_positive, false_negative, true_negative, false_positive = samples
     data_extraction.end_time(start)
 
-    print ('Filtering data.')
-    ipd = arguments.ipd
-    fold_change = arguments.fold_change
-
-    true_positive = data[((data['top_ipd'] > ipd) | (data['bottom_ipd'] > ipd)) & (data['fold_change'] > fold_change)]
-    false_negative = data[(data['top_ipd'] < ipd) & (data['bottom_ipd'] < ipd) & (data['fold_change'] > fold_change)]
-    true_negative = data[(data['top_ipd'] < ipd) & (data['bottom_ipd'] < ipd) & (data['fold_change'] < fold_change)]
-    false_positive = data[((data['top_ipd'] > ipd) | (data['bottom_ipd'] > ipd)) & (data['fold_change'] < fold_change)]
-
-    print ('Sampling data.')
-    true_positive = data_extraction.sample(true_positive, arguments.examples)
-    false_positive = data_extraction.sample(false_positive, arguments.examples)
-    true_negative = data_extraction.sample(true_negative, arguments.examples)
-    false_negative = data_extraction.sample(false_negative, arguments.examples)
+    start = data_extraction.start_time('Reading data.')
+    data = data_extraction.read_data(arguments.infile, arguments.columns)
+    data_extraction.end_time(start)
 
     start = data_extraction.start_time('Extracting windows.')
-    true_positive_features, true_positive_positions = data_extraction.windows(true_positive, data, arguments.window, arguments.columns)
-    false_negative_features, false_negative_positions = data_extraction.windows(false_negative, data, arguments.window, arguments.columns)
-    true_negative_features, true_negative_positions = data_extraction.windows(true_negative, data, arguments.window, arguments.columns)
-    false_positive_features, false_positive_positions = data_extraction.windows(false_positive, data, arguments.window, arguments.columns)
+    extractor = data_extraction.open_windows(data, arguments.columns, arguments.jobs)
+    true_positive_features, true_positive_positions = data_extraction.windows(true_positive, extractor, arguments.window)
+    false_negative_features, false_negative_positions = data_extraction.windows(false_negative, extractor, arguments.window)
+    true_negative_features, true_negative_positions = data_extraction.windows(true_negative, extractor, arguments.window)
+    false_positive_features, false_positive_positions = data_extraction.windows(false_positive, extractor, arguments.window)
+    data_extraction.close_windows(extractor)
     data_extraction.end_time(start)
 
     print ('Creating labels.')
@@ -48,7 +57,7 @@ def main():
     labels = np.hstack([np.ones(len(true_positive_features)), 
                         np.ones(len(false_negative_features)),
                         np.zeros(len(true_negative_features)),
-                        np.zeros(len(false_positive_features))])
+                        np.zeros(len(false_positive_features))]).astype(np.int8)
 
     project_folder = data_extraction.project_path()
     data_folder = os.path.join(project_folder, 'data')
@@ -66,80 +75,45 @@ def main():
                   [2] * len(true_negative_features) + \
                   [3] * len(false_positive_features)
 
-        data = {'classes': {0: 'True Positive', 
-                            1: 'False Negative',
-                            2: 'True Negative',
-                            3: 'False Positive'},
-                'columns': column_labels,
-                'vectors': features.tolist(), 
-                'positions': positions.tolist(), 
-                'labels': classes}
+        names = {'classes': {0: 'True Positive', 
+                             1: 'False Negative',
+                             2: 'True Negative',
+                             3: 'False Positive'}}
 
         if arguments.prefix:
-            filename = os.path.join(interm_folder, f'{arguments.prefix}_classes.json')
-        else:
-            filename = os.path.join(interm_folder, 'classes.json')
-
-        with open(filename, 'w') as outfile:
-            json.dump(data, outfile, indent = 4)
-
-        tp_seqeunces = data_extraction.create_fasta(true_positive_features, arguments.window)
-        fn_seqeunces = data_extraction.create_fasta(false_negative_features, arguments.window)
-        tn_seqeunces = data_extraction.create_fasta(true_negative_features, arguments.window)
-        fp_seqeunces = data_extraction.create_fasta(false_positive_features, arguments.window)
-
-        if arguments.prefix:        
-            filename = os.path.join(interm_folder, f'{arguments.prefix}_tp.fasta')
-            with open(filename, 'w') as outfile:
-                outfile.write(tp_seqeunces)
-
-            filename = os.path.join(interm_folder, f'{arguments.prefix}_fn.fasta')
-            with open(filename, 'w') as outfile:
-                outfile.write(fn_seqeunces)
-
-            filename = os.path.join(interm_folder, f'{arguments.prefix}_tn.fasta')
-            with open(filename, 'w') as outfile:
-                outfile.write(tn_seqeunces)
-
-            filename = os.path.join(interm_folder, f'{arguments.prefix}_fp.fasta')
-            with open(filename, 'w') as outfile:
-                outfile.write(fp_seqeunces)
-
+            filename = os.path.join(interm_folder, f'{arguments.prefix}_classes')
         else:
-            filename = os.path.join(interm_folder, 'tp.fasta')
-            with open(filename, 'w') as outfile:
-                outfile.write(tp_seqeunces)
+            filename = os.path.join(interm_folder, 'classes')
 
-            filename = os.path.join(interm_folder, 'fn.fasta')
-            with open(filename, 'w') as outfile:
-                outfile.write(fn_seqeunces)
+        data_extraction.save_features(filename, column_labels, features, positions, classes, arguments.output_format, names)
 
-            filename = os.path.join(interm_folder, 'tn.fasta')
-            with open(filename, 'w') as outfile:
-                outfile.write(tn_seqeunces)
+        sequences = [('tp', true_positive_features),
+                     ('fn', false_negative_features),
+                     ('tn', true_negative_features),
+                     ('fp', false_positive_features)]
 
-            filename = os.path.join(interm_folder, 'fp.fasta')
-            with open(filename, 'w') as outfile:
-                outfile.write(fp_seqeunces)
+        for name, vectors in sequences:
+            if arguments.prefix:
+                filename = os.path.join(interm_folder, f'{arguments.prefix}_{name}.fasta')
+            else:
+                filename = os.path.join(interm_folder, f'{name}.fasta')
+            data_extraction.write_fasta(filename, vectors, arguments.window)
 
-    index = np.random.permutation(len(features))
+    index = np.random.default_rng(arguments.seed).permutation(len(features))
     features = features[index]
     positions = positions[index]
     labels = labels[index]
 
     print ('Writing output.')
-    data = {'columns': column_labels,
-            'vectors': features.tolist(), 
-            'positions': positions.tolist(), 
-            'labels': labels.tolist()}
-
     if arguments.prefix:
-        filename = os.path.join(processed_folder, f'{arguments.prefix}_data.json')
+        filename = os.path.join(processed_folder, f'{arguments.prefix}_data')
     else:
-        filename = os.path.join(processed_folder, 'data.json')
+        filename = os.path.join(processed_folder, 'data')
 
-    with open(filename, 'w') as outfile:
-        json.dump(data, outfile, indent = 4)
+    if arguments.shard_size:
+        data_extraction.save_shards(filename, column_labels, features, positions, labels, arguments.shard_size)
+    else:
+        data_extraction.save_features(filename, column_labels, features, positions, labels, arguments.output_format)
 
     total_time = data_extraction.end_time(total_start, True)
     print (f'{total_time} elapsed in total.')
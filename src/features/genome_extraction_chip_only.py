@@ -1,37 +1,44 @@
 import data_extraction
-import pandas as pd
 import numpy as np
-import json
 import os
 
+# Class of each row of fold change values: 0 above the threshold, 1 below it 
+# and -1 on it. 
+def chip_classes(values, fold_change):
+    classes = np.full(len(values), -1)
+    classes[values[:, 0] > fold_change] = 0
+    classes[values[:, 0] < fold_change] = 1
+
+    return classes
+
 def main():
     arguments = data_extraction.setup()
 
-    start = data_extraction.start_time('Reading data.')
-    data = pd.read_hdf(arguments.infile, columns = ['fold_change'] + arguments.columns)
+    # Scan only the fold change column for the positions above and below the 
+    # threshold, then load only the feature columns once for the windows. 
+    start = data_extraction.start_time('Sampling data.')
+    blocks = data_extraction.read_blocks(arguments.infile, ['fold_change'])
+    classify = lambda values: chip_classes(values, arguments.fold_change)
+    positive, negative = data_extraction.reservoir_sample(blocks, classify, 2, arguments.examples, arguments.seed)
     data_extraction.end_time(start)
 
-    print ('Filtering data.')
-    fold_change = arguments.fold_change
-    positive = data[data['fold_change'] > fold_change]
-    negative = data[data['fold_change'] < fold_change]
-
-    print ('Sampling data.')
-    positive = data_extraction.sample(positive, arguments.examples)
-    negative = data_extraction.sample(negative, arguments.examples)
+    start = data_extraction.start_time('Reading data.')
+    data = data_extraction.read_data(arguments.infile, arguments.columns)
+    data_extraction.end_time(start)
 
     start = data_extraction.start_time('Extracting windows.')
-    data = pd.read_hdf(arguments.infile)
-    positive_features, positive_positions = data_extraction.windows(positive, data, arguments.window, arguments.columns)
-    negative_features, negative_positions = data_extraction.windows(negative, data, arguments.window, arguments.columns)
+    extractor = data_extraction.open_windows(data, arguments.columns, arguments.jobs)
+    positive_features, positive_positions = data_extraction.windows(positive, extractor, arguments.window)
+    negative_features, negative_positions = data_extraction.windows(negative, extractor, arguments.window)
+    data_extraction.close_windows(extractor)
     data_extraction.end_time(start)
 
     print ('Creating labels.')
     features = np.vstack([positive_features,negative_features])
     positions = np.vstack([positive_positions,negative_positions])
-    labels = np.hstack([np.ones(len(positive_features)), np.zeros(len(negative_features))])
+    labels = np.hstack([np.ones(len(positive_features)), np.zeros(len(negative_features))]).astype(np.int8)
 
-    index = np.random.permutation(len(features))
+    index = np.random.default_rng(arguments.seed).permutation(len(features))
     features = features[index]
     positions = positions[index]
     labels = labels[index]
@@ -41,21 +48,18 @@ def main():
         column_labels += [column] * arguments.window
 
     print ('Writing output.')
-    data = {'columns': column_labels,
-            'vectors': features.tolist(), 
-            'positions': positions.tolist(), 
-            'labels': labels.tolist()}
-
     project_folder = data_extraction.project_path()
     data_folder = os.path.join(project_folder, 'data')
     processed_folder = os.path.join(data_folder, 'processed')
     if arguments.prefix:
-        filename = os.path.join(processed_folder, f'{arguments.prefix}_data.json')
+        filename = os.path.join(processed_folder, f'{arguments.prefix}_data')
     else:
-        filename = os.path.join(processed_folder, 'data.json')
+        filename = os.path.join(processed_folder, 'data')
 
-    with open(filename, 'w') as outfile:
-        json.dump(data, outfile, indent = 4)
+    if arguments.shard_size:
+        data_extraction.save_shards(filename, column_labels, features, positions, labels, arguments.shard_size)
+    else:
+        data_extraction.save_features(filename, column_labels, features, positions, labels, arguments.output_format)
 
 if __name__ == '__main__':
     main()
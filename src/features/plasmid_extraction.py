@@ -1,43 +1,58 @@
 import data_extraction
-import pandas as pd
 import numpy as np
-import json
 import time
 import os
 
+# Window every position chromosome by chromosome and write the windows in 
+# shards as they are produced, so memory depends on the shard size and the 
+# largest chromosome rather than the genome. With more than one job the 
+# windows are gathered by one pool of workers for the whole run. 
+def stream(arguments, filename, column_labels):
+    start = data_extraction.start_time('Extracting windows in shards.')
+    shards = data_extraction.open_shards(filename, column_labels, arguments.shard_size)
+    extractor = data_extraction.open_windows(jobs = arguments.jobs)
+    for chromosome, positions, values in data_extraction.read_chromosomes(arguments.infile, arguments.columns):
+        for features, windows in data_extraction.chromosome_windows(positions, values, arguments.window, arguments.shard_size, extractor):
+            data_extraction.append_shards(shards, features, windows)
+    data_extraction.close_windows(extractor)
+    data_extraction.close_shards(shards)
+    data_extraction.end_time(start)
+
 def main():
     total_start = data_extraction.start_time()
     arguments = data_extraction.setup()
 
-    start = data_extraction.start_time('Reading data.')
-    data = pd.read_hdf(arguments.infile, columns =  arguments.columns)
-    data_extraction.end_time(start)
-
-    start = data_extraction.start_time('Extracting windows.')
-    features, positions = data_extraction.windows(data.index.values, data, arguments.window, arguments.columns)
-    data_extraction.end_time(start)
-
     column_labels = []
     for column in arguments.columns:
         column_labels += [column] * arguments.window
 
-    print ('Writing output.')
-    data = {
-        'columns': column_labels,
-        'vectors': features, 
-        'positions': positions
-    }
-
     project_folder = data_extraction.project_path()
     data_folder = os.path.join(project_folder, 'data')
     processed_folder = os.path.join(data_folder, 'processed')
     if arguments.prefix:
-        filename = os.path.join(processed_folder, f'{arguments.prefix}_data.json')
+        filename = os.path.join(processed_folder, f'{arguments.prefix}_data')
     else:
-        filename = os.path.join(processed_folder, 'data.json')
+        filename = os.path.join(processed_folder, 'data')
+
+    if arguments.shard_size:
+        stream(arguments, filename, column_labels)
+        total_time = data_extraction.end_time(total_start, True)
+        print (f'{total_time} elapsed in total.')
+        return
+
+    start = data_extraction.start_time('Reading data.')
+    data = data_extraction.read_data(arguments.infile, arguments.columns)
+    data_extraction.end_time(start)
 
-    with open(filename, 'w') as outfile:
-        json.dump(data, outfile, indent = 4)
+    start = data_extraction.start_time('Extracting windows.')
+    index = data_extraction.valid_centers(data, arguments.window)
+    extractor = data_extraction.open_windows(data, arguments.columns, arguments.jobs)
+    features, positions = data_extraction.windows(index, extractor, arguments.window)
+    data_extraction.close_windows(extractor)
+    data_extraction.end_time(start)
+
+    print ('Writing output.')
+    data_extraction.save_features(filename, column_labels, features, positions, output_format = arguments.output_format)
 
     total_time = data_extraction.end_time(total_start, True)
     print (f'{total_time} elapsed in total.')
@@ -1,9 +1,11 @@
 from matplotlib import pyplot as plt
 from tensorflow import keras
+import pandas as pd
 import numpy as np
 import argparse
 import json
 import time
+import os
 
 # Return argparse arguments. 
 def setup():
@@ -24,6 +26,35 @@ def setup():
         required = True,
         help = 'Filename for model.')
 
+    parser.add_argument(
+        '--chromosomes',
+        action = 'store_true',
+        default = False,
+        help = 'Score every position of a preprocessed store or HDF file with a convolutional model.')
+
+    parser.add_argument(
+        '--columns',
+        default = ['top_A',
+                   'top_T',
+                   'top_C',
+                   'top_G', 
+                   'top_ipd', 
+                   'bottom_ipd'],
+        nargs = '+',
+        help = 'Columns the model was trained on, in order.')
+
+    parser.add_argument(
+        '--block-size',
+        default = 0,
+        type = int,
+        help = 'Score chromosomes in blocks of this many positions. Whole chromosomes when 0.')
+
+    parser.add_argument(
+        '-p', 
+        '--prefix', 
+        default = False,
+        help = 'Output prefix.')
+
     return parser.parse_args()
 
 # Start the timer. 
@@ -43,13 +74,114 @@ def end_time(start, stop = False):
     print (f'{string} elapsed.')
 
 
+# Memory-map one array of a feature folder. The shards of a sharded folder 
+# are concatenated in order. 
+def load_array(folder, name):
+    with open(os.path.join(folder, 'manifest.json')) as infile:
+        manifest = json.load(infile)
+
+    if manifest['format'] == 'shards':
+        arrays = []
+        for shard in manifest['shards']:
+            arrays.append(np.load(os.path.join(folder, shard['name'], f'{name}.npy'), mmap_mode = 'r'))
+        return np.concatenate(arrays)
+
+    return np.load(os.path.join(folder, f'{name}.npy'), mmap_mode = 'r')
+
+# Load feature vectors and window positions from a folder of .npy arrays, 
+# which are memory-mapped, or from a JSON file. Vectors are cast to single 
+# precision once here (a no-op for float32 arrays). 
 def load(filename):
+    if os.path.isdir(filename):
+        data = np.asarray(load_array(filename, 'vectors'), dtype = np.float32)
+        positions = load_array(filename, 'positions')
+        return data, positions
+
     with open(filename) as infile:
         contents = json.load(infile)
         data = contents['vectors']
         positions = contents['positions']
 
-    return np.array(data), np.array(positions)
+    return np.array(data, dtype = np.float32), np.array(positions)
+
+# Return path to project level. 
+def project_path():
+    script_path = os.path.abspath(__file__)
+    script_folder = os.path.dirname(script_path)
+    src_folder = os.path.dirname(script_folder)
+    project_folder = os.path.dirname(src_folder)
+    
+    return project_folder
+
+# Read the selected columns of a preprocessed columnar store or HDF file one 
+# chromosome at a time as (chromosome, sorted positions, values). 
+def read_chromosomes(filename, columns):
+    if os.path.isdir(filename):
+        with open(os.path.join(filename, 'manifest.json')) as infile:
+            manifest = json.load(infile)
+        for entry in manifest['chromosomes']:
+            if entry['length'] == 0:
+                continue
+            folder = os.path.join(filename, entry['folder'])
+            positions = np.fromfile(os.path.join(folder, 'position.bin'), dtype = manifest['columns']['position'])
+            values = []
+            for column in columns:
+                values.append(np.fromfile(os.path.join(folder, f'{column}.bin'), dtype = manifest['columns'][column]))
+            yield entry['name'], positions, np.column_stack(values).astype(np.float32)
+        return
+
+    data = pd.read_hdf(filename, columns = columns)
+    for chromosome, group in data.groupby(level = 0, observed = True):
+        group = group.sort_index()
+        yield str(chromosome), group.index.get_level_values(1).values, group[columns].to_numpy(dtype = np.float32)
+
+# Score every position of a chromosome with the scorer layers of a 
+# convolutional model, which take a (length, channels) track of any length. 
+# Missing positions are filled with zeros and get a NaN score. Blocks overlap 
+# by the reach of the convolutions so their scores equal one whole pass. 
+def score_chromosome(scorer, positions, values, block_size = 0):
+    first = positions[0]
+    length = positions[-1] - first + 1
+    track = np.zeros((length, values.shape[1]), dtype = np.float32)
+    track[positions - first] = values
+
+    margin = 0
+    for layer in scorer.layers:
+        if isinstance(layer, keras.layers.Conv1D):
+            margin += (layer.kernel_size[0] - 1) // 2
+    if not block_size:
+        block_size = length
+
+    scores = np.full(length, np.nan, dtype = np.float32)
+    for start in range(0, length, block_size):
+        end = min(start + block_size, length)
+        lower = max(start - margin, 0)
+        upper = min(end + margin, length)
+        current = scorer.predict(track[None, lower:upper], verbose = 0)[0, :, 0]
+        scores[start:end] = current[start - lower:end - lower]
+
+    valid = np.zeros(length, dtype = bool)
+    valid[positions - first] = True
+    scores[~valid] = np.nan
+
+    return first, scores
+
+# Score every chromosome and write one .npy score track per chromosome with a 
+# manifest of the chromosome names and the position of each first score. 
+def score_chromosomes(model, filename, columns, folder, block_size = 0):
+    scorer = model.get_layer('scorer')
+    os.makedirs(folder, exist_ok = True)
+
+    chromosomes = []
+    for i, (chromosome, positions, values) in enumerate(read_chromosomes(filename, columns)):
+        print (f'Scoring {chromosome}.')
+        first, scores = score_chromosome(scorer, positions, values, block_size)
+        np.save(os.path.join(folder, f'{i}.npy'), scores)
+        chromosomes.append({'name': chromosome, 'file': f'{i}.npy', 'first': int(first), 'length': len(scores)})
+
+    manifest = {'format': 'scores', 'version': 1, 'columns': columns, 'chromosomes': chromosomes}
+    with open(os.path.join(folder, 'manifest.json'), 'w') as outfile:
+        json.dump(manifest, outfile, indent = 4)
 
 def feature_importance(vector, prediction, model):
     features = np.zeros(50)
@@ -78,6 +210,18 @@ def feature_importance(vector, prediction, model):
 def main():
     arguments = setup()
     model = keras.models.load_model(arguments.model)
+
+    if arguments.chromosomes:
+        start = start_time('Scoring chromosomes.')
+        processed_folder = os.path.join(project_path(), 'data', 'processed')
+        if arguments.prefix:
+            folder = os.path.join(processed_folder, f'{arguments.prefix}_scores')
+        else:
+            folder = os.path.join(processed_folder, 'scores')
+        score_chromosomes(model, arguments.input, arguments.columns, folder, arguments.block_size)
+        end_time(start)
+        return
+
     data, positions = load(arguments.input)
 
     predictions = model.predict(data)
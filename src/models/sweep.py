@@ -0,0 +1,262 @@
+from sklearn import model_selection
+from sklearn import metrics
+import multiprocessing
+import train_model
+import numpy as np
+import itertools
+import argparse
+import resource
+import shutil
+import json
+import time
+import csv
+import os
+
+# Return argparse arguments. 
+def setup():
+    parser = argparse.ArgumentParser(
+        description = 'Cross validate every configuration of a parameter grid and rank them.')
+
+    parser.version = 0.1
+
+    parser.add_argument(
+        '-i',
+        '--input',
+        required = True,
+        help = 'Input folder or JSON file of feature vectors.')
+
+    parser.add_argument(
+        '-g',
+        '--grid',
+        required = True,
+        help = 'JSON file mapping parameters to lists of values, e.g. {"layers": [[300, 150, 50], [128, 64]], "dropout": [0.2, 0.5]}.')
+
+    parser.add_argument(
+        '-f',
+        '--folds',
+        default = 5,
+        type = int,
+        help = 'Number of cross validation folds.')
+
+    parser.add_argument(
+        '--validation',
+        default = 0.1,
+        type = float,
+        help = 'Fraction of the training rows of each fold held out for early stopping.')
+
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        default = 1,
+        type = int,
+        help = 'Number of trials trained at once.')
+
+    parser.add_argument(
+        '-p',
+        '--prefix',
+        default = False,
+        help = 'Output prefix.')
+
+    arguments = parser.parse_args()
+    if not 0 < arguments.validation < 1:
+        parser.error('--validation must be between 0 and 1')
+
+    return arguments
+
+# Parameters that can be swept and their values when the grid leaves them 
+# out, which match train_model. 
+default_grid = {
+    'architecture': ['dense'],
+    'layers': [[300, 150, 50]],
+    'dropout': [0.5],
+    'epochs': [10],
+    'patience': [3],
+    'batch_size': [32],
+    'window': [50]
+}
+
+# Every combination of the parameter values in the grid. 
+def configurations(grid):
+    for key in grid:
+        if key not in default_grid:
+            raise ValueError(f'Unknown sweep parameter {key}.')
+
+    grid = dict(default_grid, **grid)
+    keys = list(grid)
+    output = []
+    for values in itertools.product(*[grid[key] for key in keys]):
+        output.append(dict(zip(keys, values)))
+
+    return output
+
+# Write the train, validation and test row numbers of each fold once as .npy 
+# files. The validation rows are a fraction of the training rows held out for 
+# early stopping. A feature folder is read in place, a JSON file is converted 
+# once to a single vectors.npy that every trial memory-maps. The folds are 
+# reused while the input file, the number of folds and the validation 
+# fraction are unchanged. Returns the feature source and the fold folders. 
+def cache_folds(filename, folder, folds, validation = 0.1):
+    if os.path.isdir(filename):
+        modified = os.path.getmtime(os.path.join(filename, 'manifest.json'))
+        source = filename
+    else:
+        modified = os.path.getmtime(filename)
+        source = folder
+    key = {'input': os.path.abspath(filename), 'modified': modified, 'folds': folds, 'validation': validation}
+    folders = [os.path.join(folder, f'fold_{i + 1}') for i in range(folds)]
+
+    manifest_file = os.path.join(folder, 'manifest.json')
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as infile:
+            if json.load(infile).get('key') == key:
+                print ('Using cached folds.')
+                return source, folders
+        shutil.rmtree(folder)
+    os.makedirs(folder, exist_ok = True)
+
+    if os.path.isdir(filename):
+        labels = train_model.load_array(filename, 'labels')
+    else:
+        data, labels = train_model.load(filename)
+        np.save(os.path.join(folder, 'vectors.npy'), data)
+        np.save(os.path.join(folder, 'labels.npy'), labels)
+        del data
+
+    for fold_folder, (train, test) in zip(folders, model_selection.KFold(n_splits = folds).split(labels)):
+        train, held_out = train_model.validation_split(train, validation)
+        os.makedirs(fold_folder, exist_ok = True)
+        np.save(os.path.join(fold_folder, 'train.npy'), train)
+        np.save(os.path.join(fold_folder, 'validation.npy'), held_out)
+        np.save(os.path.join(fold_folder, 'test.npy'), test)
+
+    with open(manifest_file, 'w') as outfile:
+        json.dump({'format': 'features', 'key': key}, outfile, indent = 4)
+
+    return source, folders
+
+# Bound the threads TensorFlow uses in a trial worker. 
+def start_worker(threads):
+    train_model.tf.config.threading.set_intra_op_parallelism_threads(threads)
+    train_model.tf.config.threading.set_inter_op_parallelism_threads(threads)
+
+# Train one configuration on one cached fold and score it. Only the rows of 
+# the fold are read from the memory-mapped features. Early stopping watches 
+# the validation rows, the test rows are only scored. Each trial runs in a 
+# fresh process, so the peak resident memory is the trial's own. 
+def run_trial(task):
+    index, configuration, source, fold_folder = task
+    x, y = train_model.load_shards(source)
+    arrays = {}
+    for name in ['train', 'validation', 'test']:
+        rows = np.load(os.path.join(fold_folder, f'{name}.npy'))
+        arrays[f'x_{name}'] = train_model.read_rows(x, rows)
+        arrays[f'y_{name}'] = y[rows]
+
+    start = time.time()
+    model = train_model.create_model(
+        arrays['x_train'].shape[1],
+        configuration['architecture'],
+        configuration['window'],
+        configuration['layers'],
+        configuration['dropout'])
+    y_scores, history = train_model.train_network(
+        model,
+        arrays['x_train'],
+        arrays['y_train'],
+        arrays['x_test'],
+        epochs = configuration['epochs'],
+        patience = configuration['patience'],
+        batch_size = configuration['batch_size'],
+        x_validation = arrays['x_validation'],
+        y_validation = arrays['y_validation'])
+    seconds = time.time() - start
+
+    return {
+        'index': index,
+        'auc': metrics.roc_auc_score(arrays['y_test'], y_scores),
+        'ap': metrics.average_precision_score(arrays['y_test'], y_scores),
+        'seconds': seconds,
+        'samples_per_second': len(arrays['x_train']) * len(history['loss']) / seconds,
+        'peak_memory': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    }
+
+# Combine the fold results of each configuration into a leaderboard sorted 
+# by mean AUC. Time is summed over the folds and memory is the largest peak 
+# in MB. 
+def leaderboard(configurations, results):
+    rows = []
+    for i, configuration in enumerate(configurations):
+        current = [result for result in results if result['index'] == i]
+        aucs = [result['auc'] for result in current]
+        aps = [result['ap'] for result in current]
+        row = dict(configuration)
+        row['layers'] = '-'.join(str(units) for units in configuration['layers'])
+        row['auc_mean'] = float(np.mean(aucs))
+        row['auc_std'] = float(np.std(aucs))
+        row['ap_mean'] = float(np.mean(aps))
+        row['ap_std'] = float(np.std(aps))
+        row['seconds'] = float(sum(result['seconds'] for result in current))
+        row['peak_memory'] = float(max(result['peak_memory'] for result in current))
+        row['samples_per_second'] = float(np.mean([result['samples_per_second'] for result in current]))
+        rows.append(row)
+
+    rows.sort(key = lambda row: row['auc_mean'], reverse = True)
+    for rank, row in enumerate(rows):
+        row['rank'] = rank + 1
+
+    return rows
+
+# Write the leaderboard as CSV and JSON. 
+def save_leaderboard(rows, filename):
+    columns = ['rank'] + [column for column in rows[0] if column != 'rank']
+    with open(f'{filename}.csv', 'w', newline = '') as outfile:
+        writer = csv.DictWriter(outfile, fieldnames = columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    with open(f'{filename}.json', 'w') as outfile:
+        json.dump(rows, outfile, indent = 4)
+
+def main():
+    total_start = train_model.start_time()
+    arguments = setup()
+
+    with open(arguments.grid) as infile:
+        grid = configurations(json.load(infile))
+
+    project_folder = train_model.project_path()
+    interm_folder = os.path.join(project_folder, 'data', 'interm')
+    reports_folder = os.path.join(project_folder, 'reports')
+    if arguments.prefix:
+        folds_folder = os.path.join(interm_folder, f'{arguments.prefix}_folds')
+        filename = os.path.join(reports_folder, f'{arguments.prefix}_sweep')
+    else:
+        folds_folder = os.path.join(interm_folder, 'folds')
+        filename = os.path.join(reports_folder, 'sweep')
+
+    start = train_model.start_time('Building folds.')
+    source, folders = cache_folds(arguments.input, folds_folder, arguments.folds, arguments.validation)
+    train_model.end_time(start)
+
+    tasks = []
+    for i, configuration in enumerate(grid):
+        for fold_folder in folders:
+            tasks.append((i, configuration, source, fold_folder))
+
+    start = train_model.start_time(f'Running {len(tasks)} trials of {len(grid)} configurations.')
+    threads = max(1, os.cpu_count() // arguments.jobs)
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(arguments.jobs, initializer = start_worker, initargs = (threads,), maxtasksperchild = 1) as pool:
+        results = pool.map(run_trial, tasks, chunksize = 1)
+    train_model.end_time(start)
+
+    rows = leaderboard(grid, results)
+    save_leaderboard(rows, filename)
+    for row in rows[:5]:
+        print (f"{row['rank']}. AUC {row['auc_mean']:.3f} AP {row['ap_mean']:.3f} layers {row['layers']} dropout {row['dropout']} epochs {row['epochs']}")
+
+    total_time = train_model.end_time(total_start, True)
+    print (f'{total_time} elapsed in total.')
+
+if __name__ == '__main__':
+    main()
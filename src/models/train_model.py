@@ -3,9 +3,14 @@ from matplotlib import pyplot as plt
 from sklearn import model_selection
 from sklearn import metrics
 from tensorflow import keras
+import tensorflow as tf
+import multiprocessing
 import numpy as np
 import argparse
+import resource
+import shutil
 import json
+import csv
 import time
 import os
 
@@ -20,7 +25,7 @@ def setup():
         '-i', 
         '--input', 
         required = True,
-        help = 'Input file feature vectors.')
+        help = 'Input folder or JSON file of feature vectors.')
 
     parser.add_argument(
         '-p', 
@@ -28,7 +33,72 @@ def setup():
         default = False,
         help = 'Output prefix.')
 
-    return parser.parse_args()
+    parser.add_argument(
+        '--stream',
+        action = 'store_true',
+        default = False,
+        help = 'Stream batches from the memory-mapped feature shards instead of loading them.')
+
+    parser.add_argument(
+        '--batch-size',
+        default = 32,
+        type = int,
+        help = 'Number of examples in each training batch.')
+
+    parser.add_argument(
+        '--shuffle-buffer',
+        default = 1000000,
+        type = int,
+        help = 'Number of example rows in the shuffle buffer when streaming.')
+
+    parser.add_argument(
+        '--parallel-folds',
+        default = 0,
+        type = int,
+        help = 'Train this many cross validation folds at once in worker processes. Sequential when 0.')
+
+    parser.add_argument(
+        '--architecture',
+        default = 'dense',
+        choices = ['dense', 'convolutional'],
+        help = 'Dense network on window vectors, or convolutional network that can also score whole chromosomes.')
+
+    parser.add_argument(
+        '-w', 
+        '--window', 
+        default = 50,
+        type = int, 
+        help = 'The size of the windows in the feature vectors.')
+
+    parser.add_argument(
+        '--epochs',
+        default = 10,
+        type = int,
+        help = 'Maximum number of training epochs.')
+
+    parser.add_argument(
+        '--patience',
+        default = 3,
+        type = int,
+        help = 'Stop training after this many epochs without a lower validation loss.')
+
+    parser.add_argument(
+        '--validation',
+        default = 0.1,
+        type = float,
+        help = 'Fraction of the training rows of each fold held out for early stopping.')
+
+    parser.add_argument(
+        '--resume',
+        action = 'store_true',
+        default = False,
+        help = 'Continue each model from its last checkpoint under models/.')
+
+    arguments = parser.parse_args()
+    if not 0 < arguments.validation < 1:
+        parser.error('--validation must be between 0 and 1')
+
+    return arguments
 
 # Start the timer. 
 def start_time(string = None):
@@ -55,36 +125,367 @@ def project_path():
     
     return project_folder
 
+# Memory-map one array of a feature folder. The shards of a sharded folder 
+# are concatenated in order. 
+def load_array(folder, name):
+    with open(os.path.join(folder, 'manifest.json')) as infile:
+        manifest = json.load(infile)
+
+    if manifest['format'] == 'shards':
+        arrays = []
+        for shard in manifest['shards']:
+            arrays.append(np.load(os.path.join(folder, shard['name'], f'{name}.npy'), mmap_mode = 'r'))
+        return np.concatenate(arrays)
+
+    return np.load(os.path.join(folder, f'{name}.npy'), mmap_mode = 'r')
+
+# Load feature vectors and labels from a folder of .npy arrays, which are 
+# memory-mapped, or from a JSON file. Vectors are cast to single precision 
+# once here (a no-op for float32 arrays) so Keras does not convert every 
+# batch. 
 def load(filename):
+    if os.path.isdir(filename):
+        data = np.asarray(load_array(filename, 'vectors'), dtype = np.float32)
+        labels = load_array(filename, 'labels')
+        return data, labels
+
     with open(filename) as infile:
         contents = json.load(infile)
-        data = np.array(contents['vectors'])
-        labels = np.array(contents['labels'])
+        data = np.array(contents['vectors'], dtype = np.float32)
+        labels = np.array(contents['labels'], dtype = np.int8)
 
     return data, labels
 
-def create_model(input_dim):
+# Memory-map the feature vectors of a folder as a list of arrays, one per 
+# shard, with the first row of each and one past the last, and load the 
+# labels. A JSON file is loaded as a single array. 
+def load_shards(filename):
+    if not os.path.isdir(filename):
+        data, labels = load(filename)
+        return ([data], np.array([0, len(data)])), labels
+
+    with open(os.path.join(filename, 'manifest.json')) as infile:
+        manifest = json.load(infile)
+
+    if manifest['format'] == 'shards':
+        folders = [os.path.join(filename, shard['name']) for shard in manifest['shards']]
+    else:
+        folders = [filename]
+
+    arrays = [np.load(os.path.join(folder, 'vectors.npy'), mmap_mode = 'r') for folder in folders]
+    offsets = np.cumsum([0] + [len(array) for array in arrays])
+    labels = load_array(filename, 'labels')
+
+    return (arrays, offsets), np.asarray(labels)
+
+# Read the given rows from the shards in order. Rows are read shard by shard 
+# in sorted order and put back in the requested order. 
+def read_rows(source, rows):
+    arrays, offsets = source
+    order = np.argsort(rows, kind = 'stable')
+    sorted_rows = rows[order]
+    shards = np.searchsorted(offsets, sorted_rows, side = 'right') - 1
+
+    output = np.zeros((len(rows), arrays[0].shape[1]), dtype = np.float32)
+    for shard in np.unique(shards):
+        selection = shards == shard
+        output[order[selection]] = arrays[shard][sorted_rows[selection] - offsets[shard]]
+
+    return output
+
+# Dataset of (vectors, labels) batches that reads the given rows from the 
+# shards as it goes, so only a few batches are in memory. Row numbers are 
+# shuffled in a buffer, batches are read by parallel calls and prefetched 
+# while the model trains. 
+def dataset(source, labels, rows, batch_size, shuffle_buffer = 0):
+    width = source[0][0].shape[1]
+
+    def read(batch):
+        return read_rows(source, batch), labels[batch].astype(np.float32)
+
+    def decode(batch):
+        vectors, targets = tf.numpy_function(read, [batch], [tf.float32, tf.float32])
+        vectors.set_shape([None, width])
+        targets.set_shape([None])
+        return vectors, targets
+
+    data = tf.data.Dataset.from_tensor_slices(np.asarray(rows, dtype = np.int64))
+    if shuffle_buffer:
+        data = data.shuffle(min(shuffle_buffer, len(rows)), reshuffle_each_iteration = True)
+    data = data.batch(batch_size)
+    data = data.map(decode, num_parallel_calls = tf.data.AUTOTUNE)
+
+    return data.prefetch(tf.data.AUTOTUNE)
+
+# Convolutional network over the per-base channels of a window. The layers 
+# named scorer map a (length, channels) track of any length to a score per 
+# position, and the model trains them on the score of the window center. 
+# The scorer sees 12 bases on each side, so the window must hold 12 bases on 
+# both sides of its center (at least 26 bases for an even window). Then the 
+# center score never sees padding and a whole chromosome can be scored in one 
+# pass with the same weights. 
+def create_convolutional_model(input_dim, window):
+    reach = 12
+    radius = int(window/2)
+    if min(radius, window - radius - 1) < reach:
+        raise ValueError(f'The convolutional model needs at least {reach} bases on each side of the window center, a window of {window} has {min(radius, window - radius - 1)}.')
+    if input_dim % window:
+        raise ValueError(f'The input has {input_dim} columns, which is not a whole number of channels of {window} bases.')
+    channels = input_dim // window
+
+    scorer = keras.Sequential(name = 'scorer')
+    scorer.add(keras.layers.Conv1D(64, 9, padding = 'same', activation = 'relu', input_shape = (None, channels)))
+    scorer.add(keras.layers.Dropout(0.5))
+    scorer.add(keras.layers.Conv1D(64, 9, padding = 'same', activation = 'relu'))
+    scorer.add(keras.layers.Dropout(0.5))
+    scorer.add(keras.layers.Conv1D(32, 9, padding = 'same', activation = 'relu'))
+    scorer.add(keras.layers.Conv1D(1, 1, activation = 'sigmoid'))
+
     model = keras.Sequential()
-    model.add(keras.layers.Dense(300, input_dim = input_dim, activation="relu"))
-    model.add(keras.layers.Dropout(0.5))
-    model.add(keras.layers.Dense(150, activation="relu"))
-    model.add(keras.layers.Dropout(0.5))
-    model.add(keras.layers.Dense(50, activation="relu"))
+    model.add(keras.layers.Reshape((channels, window), input_shape = (input_dim,)))
+    model.add(keras.layers.Permute((2, 1)))
+    model.add(scorer)
+    model.add(keras.layers.Cropping1D((radius, window - radius - 1)))
+    model.add(keras.layers.Flatten())
+    model.compile(optimizer="adam", loss="binary_crossentropy", metrics = ['accuracy'], verbose = 0)
+
+    return model
+
+# Dense network with the given hidden layer sizes and dropout after each 
+# hidden layer but the last, or the convolutional network. 
+def create_model(input_dim, architecture = 'dense', window = 50, layers = (300, 150, 50), dropout = 0.5):
+    if architecture == 'convolutional':
+        return create_convolutional_model(input_dim, window)
+
+    model = keras.Sequential()
+    model.add(keras.layers.Dense(layers[0], input_dim = input_dim, activation="relu"))
+    for units in layers[1:]:
+        model.add(keras.layers.Dropout(dropout))
+        model.add(keras.layers.Dense(units, activation="relu"))
     model.add(keras.layers.Dense(1, activation="sigmoid"))
     model.compile(optimizer="adam", loss="binary_crossentropy", metrics = ['accuracy'], verbose = 0)
 
     return model
 
-def train_network(model, x_train, y_train, x_test = None, y_test = None, filename = None):
+# CPU time used by this process in seconds. 
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+# Keras callback that records the throughput and resources of each training 
+# epoch: training samples per second, mean step time, peak resident memory of 
+# the process in MB and the CPU time used as a fraction of all cores. 
+class Throughput(keras.callbacks.Callback):
+    def __init__(self, samples):
+        super().__init__()
+        self.samples = samples
+        self.records = []
+
+    def on_epoch_begin(self, epoch, logs = None):
+        self.epoch_start = time.time()
+        self.train_end = self.epoch_start
+        self.cpu_start = cpu_seconds()
+        self.steps = 0
+        self.step_seconds = 0
+
+    def on_train_batch_begin(self, batch, logs = None):
+        self.step_start = time.time()
+
+    def on_train_batch_end(self, batch, logs = None):
+        self.train_end = time.time()
+        self.steps += 1
+        self.step_seconds += self.train_end - self.step_start
+
+    def on_epoch_end(self, epoch, logs = None):
+        seconds = time.time() - self.epoch_start
+        train_seconds = max(self.train_end - self.epoch_start, 1e-9)
+        self.records.append({
+            'epoch': epoch + 1,
+            'seconds': seconds,
+            'samples_per_second': self.samples / train_seconds,
+            'step_time': self.step_seconds / max(self.steps, 1),
+            'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'cpu_utilization': (cpu_seconds() - self.cpu_start) / seconds / os.cpu_count()
+        })
+
+# Write the epoch records of each model as CSV and JSON files. 
+def save_throughput(records, filename):
+    rows = []
+    for name, current in records:
+        for record in current:
+            rows.append(dict(record, model = name))
+
+    columns = ['model', 'epoch', 'seconds', 'samples_per_second', 'step_time', 'peak_rss', 'cpu_utilization']
+    with open(f'{filename}.csv', 'w', newline = '') as outfile:
+        writer = csv.DictWriter(outfile, fieldnames = columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    with open(f'{filename}.json', 'w') as outfile:
+        json.dump(rows, outfile, indent = 4)
+
+# Keras callback that keeps only the checkpoint of the last epoch in a 
+# folder, with the early stopping state and the best weights so far, and 
+# puts that state back when a resumed fit starts. The state file names the 
+# saved epoch, so older files are only removed once it is written. 
+class Checkpoint(keras.callbacks.Callback):
+    def __init__(self, folder, early_stopping, state = None):
+        super().__init__()
+        self.folder = folder
+        self.early_stopping = early_stopping
+        self.state = state
+
+    def on_train_begin(self, logs = None):
+        if self.state is not None:
+            self.early_stopping.best = self.state['best']
+            self.early_stopping.wait = self.state['wait']
+            self.early_stopping.best_epoch = self.state['best_epoch']
+            self.early_stopping.best_weights = self.state['best_weights']
+
+    def on_epoch_end(self, epoch, logs = None):
+        name = f'epoch_{epoch + 1:03d}'
+        self.model.save(os.path.join(self.folder, name), save_format = 'tf')
+        weights = self.early_stopping.best_weights
+        if weights is not None:
+            np.savez(os.path.join(self.folder, f'weights_{epoch + 1:03d}.npz'), *weights)
+
+        state = {
+            'epoch': epoch + 1,
+            'best': float(self.early_stopping.best),
+            'wait': int(self.early_stopping.wait),
+            'best_epoch': int(getattr(self.early_stopping, 'best_epoch', 0)),
+            'weights': weights is not None
+        }
+        temporary = os.path.join(self.folder, 'state.json.tmp')
+        with open(temporary, 'w') as outfile:
+            json.dump(state, outfile, indent = 4)
+        os.replace(temporary, os.path.join(self.folder, 'state.json'))
+
+        remove_checkpoints(self.folder, keep = epoch + 1)
+
+# Remove the epoch checkpoints and best weights of a folder, except those of 
+# the given epoch. 
+def remove_checkpoints(folder, keep = None):
+    for name in os.listdir(folder):
+        if name.startswith('epoch_') or name.startswith('weights_'):
+            if keep is None or int(name.split('_')[1].split('.')[0]) != keep:
+                path = os.path.join(folder, name)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+
+# Read the early stopping state saved with the last epoch checkpoint of a 
+# folder, with the best weights so far as a list of arrays, or None when no 
+# epoch was saved. 
+def read_state(folder):
+    filename = os.path.join(folder, 'state.json')
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as infile:
+        state = json.load(infile)
+
+    state['best_weights'] = None
+    if state['weights']:
+        with np.load(os.path.join(folder, f"weights_{state['epoch']:03d}.npz")) as arrays:
+            state['best_weights'] = [arrays[f'arr_{i}'] for i in range(len(arrays.files))]
+
+    return state
+
+# Read the history logged before the given epoch and rewrite the log with 
+# only those epochs, so new epochs are appended after them. 
+def read_history(filename, epochs):
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as infile:
+        rows = [row for row in csv.DictReader(infile) if int(row['epoch']) < epochs]
+
+    history = {}
+    with open(filename, 'w', newline = '') as outfile:
+        if rows:
+            writer = csv.DictWriter(outfile, fieldnames = list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+    for row in rows:
+        for key, value in row.items():
+            if key != 'epoch':
+                history.setdefault(key, []).append(float(value))
+
+    return history
+
+# Train the model for up to the given number of epochs, stopping early when 
+# the loss on the validation inputs (the training loss without them) stops 
+# improving and keeping the best weights. The test inputs are only scored 
+# after training. The inputs are arrays, or datasets of (vectors, labels) 
+# batches with the labels given as None. With a checkpoint folder the model 
+# of the last epoch, the early stopping state and the history are saved after 
+# every epoch, and resuming continues from the saved epoch with that state. A 
+# finished model is kept as best, so resuming a finished run only reloads it. 
+# The batch size only applies to arrays. Extra callbacks are added to the fit. 
+def train_network(model, x_train, y_train, x_test = None, y_test = None, filename = None, epochs = 10, patience = 3, checkpoints = None, resume = False, batch_size = None, extra_callbacks = [], x_validation = None, y_validation = None):
+    validation_data = None
+    monitor = 'loss'
+    if x_validation is not None:
+        monitor = 'val_loss'
+        if y_validation is None:
+            validation_data = x_validation
+        else:
+            validation_data = (x_validation, y_validation)
+
+    early_stopping = keras.callbacks.EarlyStopping(monitor = monitor, patience = patience, restore_best_weights = True)
+    callbacks = [early_stopping]
+    callbacks += extra_callbacks
+    initial_epoch = 0
+    history = {}
+    complete = False
+    if checkpoints:
+        log = os.path.join(checkpoints, 'history.csv')
+        best = os.path.join(checkpoints, 'best')
+        state = None
+        if resume and os.path.exists(checkpoints):
+            complete = os.path.exists(best)
+            if complete:
+                model = keras.models.load_model(best)
+                history = read_history(log, epochs)
+            else:
+                state = read_state(checkpoints)
+                if state:
+                    initial_epoch = state['epoch']
+                    print (f'Resuming from epoch {initial_epoch}.')
+                    model = keras.models.load_model(os.path.join(checkpoints, f'epoch_{initial_epoch:03d}'))
+                    history = read_history(log, initial_epoch)
+        else:
+            if os.path.exists(checkpoints):
+                shutil.rmtree(checkpoints)
+            os.makedirs(checkpoints)
+        callbacks.append(keras.callbacks.CSVLogger(log, append = initial_epoch > 0))
+        callbacks.append(Checkpoint(checkpoints, early_stopping, state))
+
+    if not complete and initial_epoch < epochs:
+        current = model.fit(x_train, y_train, batch_size = batch_size, validation_data = validation_data, epochs = epochs, initial_epoch = initial_epoch, callbacks = callbacks, verbose = 0)
+        for key, values in current.history.items():
+            history.setdefault(key, []).extend(values)
+        if checkpoints:
+            model.save(os.path.join(checkpoints, 'best'), save_format = 'tf')
+            remove_checkpoints(checkpoints)
+
     if x_test is not None:
-        history = model.fit(x_train, y_train, validation_data = (x_test, y_test), epochs = 10, verbose = 0)
         y_scores = model.predict(x_test).reshape((-1))
         
-        return y_scores, history.history
+        return y_scores, history
     else:
-        model.fit(x_train, y_train, epochs = 10, verbose = 0)
         model.save(filename, save_format = 'tf')
 
+# Pad histories that stopped early with their last value so every fold has 
+# the same number of epochs. 
+def pad_histories(histories):
+    length = max(len(history) for history in histories)
+    output = []
+    for history in histories:
+        output.append(list(history) + [history[-1]] * (length - len(history)))
+
+    return output
+
 def shortest_row(array):
     current = 0
     length = len(array[0])
@@ -113,46 +514,125 @@ def interpolate_curve(x, y, area):
     
     return interpolate_x, mean_y, lower_y, upper_y, mean_area, std_area
     
-def plot(x, y, name, filename):
-    fprs = []
-    tprs = []
-    roc_aucs = []
-    
-    recalls = []
-    precisions = []
-    pr_aps = []
-    
-    training = []
-    validation = []
-
-    folds = 5
-    i = 1
-    for train, test in model_selection.KFold(n_splits = folds).split(x):
-        print (f'Starting Fold {i}')
+# Split training rows into the rows the model is fit on and a fraction held 
+# out for early stopping, picked with a fixed seed so resumed and repeated 
+# runs hold out the same rows. Both are returned in row order. 
+def validation_split(rows, fraction, seed = 0):
+    shuffled = np.random.default_rng(seed).permutation(rows)
+    count = int(round(len(rows) * fraction))
+
+    return np.sort(shuffled[count:]), np.sort(shuffled[:count])
+
+# Train a fresh model on one fold and score it on the held out rows. Early 
+# stopping watches a validation fraction of the training rows, so the test 
+# rows are only scored. With a batch size the features are a source of shards 
+# streamed through a dataset. The settings are passed on to train_network and 
+# the model settings to create_model. The throughput of each epoch is 
+# returned with the scores. 
+def evaluate_fold(x, y, train, test, batch_size = None, shuffle_buffer = 0, settings = {}, model_settings = {}, validation = 0.1):
+    train, held_out = validation_split(train, validation)
+    y_test = y[test]
+    throughput = Throughput(len(train))
+    if batch_size:
+        model = create_model(x[0][0].shape[1], **model_settings)
+        x_train = dataset(x, y, train, batch_size, shuffle_buffer)
+        x_test = dataset(x, y, test, batch_size)
+        x_validation = None
+        if len(held_out):
+            x_validation = dataset(x, y, held_out, batch_size)
+        y_scores, history = train_network(model, x_train, None, x_test, extra_callbacks = [throughput], x_validation = x_validation, **settings)
+    else:
         x_train = x[train]
         y_train = y[train]
         x_test = x[test]
-        y_test = y[test]
-
-        model = create_model(len(x_train[0]))
-        y_scores, history = train_network(model, x_train, y_train, x_test, y_test)
-        
-        fpr, tpr, thresholds = metrics.roc_curve(y_test, y_scores)
-        roc_auc = metrics.auc(fpr, tpr)
-        fprs.append(fpr)
-        tprs.append(tpr)
-        roc_aucs.append(roc_auc)
-        
-        precision, recall, thresholds = metrics.precision_recall_curve(y_test, y_scores)
-        pr_ap = metrics.average_precision_score(y_test, y_scores)
-        recalls.append(recall[::-1])
-        precisions.append(precision[::-1])
-        pr_aps.append(pr_ap)
-
-        training.append(history['accuracy'])
-        validation.append(history['val_accuracy'])
-
-        i += 1
+        x_validation = None
+        y_validation = None
+        if len(held_out):
+            x_validation = x[held_out]
+            y_validation = y[held_out]
+
+        model = create_model(len(x_train[0]), **model_settings)
+        y_scores, history = train_network(model, x_train, y_train, x_test, y_test, extra_callbacks = [throughput], x_validation = x_validation, y_validation = y_validation, **settings)
+
+    fpr, tpr, thresholds = metrics.roc_curve(y_test, y_scores)
+    precision, recall, thresholds = metrics.precision_recall_curve(y_test, y_scores)
+
+    return {
+        'fpr': fpr,
+        'tpr': tpr,
+        'roc_auc': metrics.auc(fpr, tpr),
+        'recall': recall[::-1],
+        'precision': precision[::-1],
+        'pr_ap': metrics.average_precision_score(y_test, y_scores),
+        'training': history['accuracy'],
+        'validation': history['val_accuracy'],
+        'throughput': throughput.records
+    }
+
+# Features loaded once in each fold worker process. 
+worker_data = {}
+
+# Bound the threads TensorFlow uses in a fold worker and load the features. 
+def start_worker(input_file, stream, threads):
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(threads)
+    if stream:
+        worker_data['features'] = load_shards(input_file)
+    else:
+        worker_data['features'] = load(input_file)
+
+# Train and score one fold in a worker process. Only the row numbers of the 
+# fold are sent, the features are read from the input file. 
+def fold_worker(task):
+    train, test, batch_size, shuffle_buffer, settings, model_settings, validation = task
+    x, y = worker_data['features']
+
+    return evaluate_fold(x, y, train, test, batch_size, shuffle_buffer, settings, model_settings, validation)
+
+# Cross validate the model and plot the training history, ROC and PR curves. 
+# With a batch size the features are a source of shards streamed through a 
+# dataset. With parallel folds each fold is trained in its own process with 
+# an equal share of the cores, reading the features from the input file. The 
+# settings are passed on to train_network, with a checkpoint folder for each 
+# fold inside the given one. The validation fraction of each fold's training 
+# rows is held out for early stopping. Returns the throughput records of each 
+# fold. 
+def plot(x, y, name, filename, batch_size = None, shuffle_buffer = 0, parallel_folds = 0, input_file = None, settings = {}, model_settings = {}, validation = 0.1):
+    folds = 5
+    splits = list(model_selection.KFold(n_splits = folds).split(y))
+    fold_settings = []
+    for i in range(folds):
+        current = dict(settings)
+        if settings.get('checkpoints'):
+            current['checkpoints'] = os.path.join(settings['checkpoints'], f'fold_{i + 1}')
+        fold_settings.append(current)
+    if parallel_folds > 1:
+        processes = min(parallel_folds, folds)
+        threads = max(1, os.cpu_count() // processes)
+        print (f'Training {folds} folds in {processes} processes with {threads} threads each.')
+        tasks = []
+        for i, (train, test) in enumerate(splits):
+            tasks.append((train, test, batch_size, shuffle_buffer, fold_settings[i], model_settings, validation))
+        context = multiprocessing.get_context('spawn')
+        initargs = (input_file, batch_size is not None, threads)
+        with context.Pool(processes, initializer = start_worker, initargs = initargs) as pool:
+            results = pool.map(fold_worker, tasks)
+    else:
+        results = []
+        for i, (train, test) in enumerate(splits):
+            print (f'Starting Fold {i + 1}')
+            results.append(evaluate_fold(x, y, train, test, batch_size, shuffle_buffer, fold_settings[i], model_settings, validation))
+
+    fprs = [result['fpr'] for result in results]
+    tprs = [result['tpr'] for result in results]
+    roc_aucs = [result['roc_auc'] for result in results]
+    
+    recalls = [result['recall'] for result in results]
+    precisions = [result['precision'] for result in results]
+    pr_aps = [result['pr_ap'] for result in results]
+    
+    training = pad_histories([result['training'] for result in results])
+    validation = pad_histories([result['validation'] for result in results])
 
     with PdfPages(filename) as pdf: 
         mean_training = np.mean(training, axis = 0)
@@ -209,39 +689,72 @@ def plot(x, y, name, filename):
         pdf.savefig()
         plt.close()
 
+    return [(f'fold_{i + 1}', result['throughput']) for i, result in enumerate(results)]
+
 def main():
     total_start = start_time()
     # Get argparse arguments. 
     arguments = setup()
 
     start = start_time('Reading data.')
-    x, y = load(arguments.input)
+    if arguments.stream:
+        x, y = load_shards(arguments.input)
+        batch_size = arguments.batch_size
+    else:
+        x, y = load(arguments.input)
+        batch_size = None
     end_time(start)
         
     start = start_time('Testing Model')
 
     project_folder = project_path()
+    models_folder = os.path.join(project_folder, 'models')
+    if arguments.prefix:
+        checkpoints = os.path.join(models_folder, f'{arguments.prefix}_checkpoints')
+    else:
+        checkpoints = os.path.join(models_folder, 'checkpoints')
+    settings = {
+        'epochs': arguments.epochs,
+        'patience': arguments.patience,
+        'resume': arguments.resume
+    }
+    model_settings = {
+        'architecture': arguments.architecture,
+        'window': arguments.window
+    }
+
     reports_folder = os.path.join(project_folder, 'reports')
     if arguments.prefix:
         filename = os.path.join(reports_folder, f'{arguments.prefix}_model_performance.pdf')
     else:
         filename = os.path.join(reports_folder, 'model_performance.pdf')
 
-    plot(x, y, 'Neural Network', filename)
+    throughput_filename = os.path.splitext(filename)[0] + '_throughput'
+    fold_settings = dict(settings, checkpoints = checkpoints)
+    records = plot(x, y, 'Neural Network', filename, batch_size, arguments.shuffle_buffer, arguments.parallel_folds, arguments.input, fold_settings, model_settings, arguments.validation)
     end_time(start) 
 
     start = start_time('Training Model')
 
-    models_folder = os.path.join(project_folder, 'models')
+    final_settings = dict(settings, checkpoints = os.path.join(checkpoints, 'final'))
     if arguments.prefix:
         filename = os.path.join(models_folder, f'{arguments.prefix}_model.h5')
     else:
         filename = os.path.join(models_folder, 'model.h5')
 
-    model = create_model(len(x[0]))
-    train_network(model, x, y, filename = filename)
+    throughput = Throughput(len(y))
+    if arguments.stream:
+        model = create_model(x[0][0].shape[1], **model_settings)
+        data = dataset(x, y, np.arange(len(y)), batch_size, arguments.shuffle_buffer)
+        train_network(model, data, None, filename = filename, extra_callbacks = [throughput], **final_settings)
+    else:
+        model = create_model(len(x[0]), **model_settings)
+        train_network(model, x, y, filename = filename, extra_callbacks = [throughput], **final_settings)
     end_time(start)
 
+    records.append(('final', throughput.records))
+    save_throughput(records, throughput_filename)
+
     total_time = end_time(total_start, True)
     print (f'{total_time} elapsed in total.')
 